@@ -1,45 +1,220 @@
 #!/usr/bin/env python3
 """
 Скрипт для анализа видео файлов в папках
-Подсчитывает количество файлов, общую длительность и размер
+Подсчитывает количество файлов, общую длительность и размер,
+а также прогнозирует стоимость апскейла FlashVSR по вариантам
 """
 
+import json
 import os
-import subprocess
+import shutil
 import sys
+from collections import Counter
+from contextlib import closing
 from pathlib import Path
 
+from media_catalog import folder_files, folder_totals, open_catalog, scan_folder
 
-def get_video_duration(video_file):
+
+# Прогноз FlashVSR: правила целевых размеров и кадров повторяют точки входа
+# (compute_scaled_and_target_dims и кадровый план 8n+1), импортировать их нельзя — они тянут torch
+VARIANTS = ('v1.1_full', 'full', 'tiny')
+# У full.py и tiny.py нет режима --bench: их время не оценивается, пока калибровку не впишут вручную
+BENCH_VARIANTS = ('v1.1_full',)
+# Калибровка пишется infer_flashvsr_v1.1_full_modified.py --bench: {вариант: {'mpf_per_s', 'device', ...}}
+THROUGHPUT_FILE = os.environ.get("FLASHVSR_THROUGHPUT_FILE", "./flashvsr_throughput.json")
+KEEP_ALL_FRAMES = os.environ.get("FLASHVSR_KEEP_ALL_FRAMES", "0") == "1"
+CHUNK_FRAMES = int(os.environ.get("FLASHVSR_CHUNK_FRAMES", "0"))
+FULL_MAX_LONG = int(os.environ.get("FLASHVSR_MAX_LONG", "0"))
+TINY_MAX_LONG = int(os.environ.get("FLASHVSR_MAX_LONG", "1536"))
+
+
+def largest_8n1_leq(n):  # 8n+1
+    return 0 if n < 1 else ((n - 1) // 8) * 8 + 1
+
+
+def smallest_8n1_geq(n):  # 8n+1
+    return largest_8n1_leq(n + 7)
+
+
+def chunk_len_8n3(n):  # 8k-3: вместе с 4 кадрами паддинга даёт 8k+1
+    return max(5, ((n + 3) // 8) * 8 - 3)
+
+
+def pipeline_frames(total, variant):
     """
-    Получает длительность видео в секундах используя ffprobe
+    Число кадров, которые пройдут через пайплайн варианта (с паддингом 4 кадра и округлением до 8n+1)
     
     Args:
-        video_file: Путь к видео файлу
+        total: Кадров в исходнике
+        variant: 'v1.1_full', 'full' или 'tiny'
     
     Returns:
-        Длительность в секундах (float) или None если не удалось определить
+        Число кадров F (для v1.1_full — сумма по чанкам FLASHVSR_CHUNK_FRAMES)
     """
-    try:
-        cmd = [
-            'ffprobe',
-            '-v', 'error',
-            '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            str(video_file)
-        ]
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
+    if variant != 'v1.1_full':
+        return largest_8n1_leq(total + 4)
+    if CHUNK_FRAMES <= 0:
+        return smallest_8n1_geq(total + 4) if KEEP_ALL_FRAMES or total < 5 else largest_8n1_leq(total + 4)
+    # Чанки режут только выходные кадры (хвост отбрасывается один раз на клип), каждый добивается до 8n+1
+    n_out = total if KEEP_ALL_FRAMES or total < 5 else largest_8n1_leq(total + 4) - 4
+    step = chunk_len_8n3(CHUNK_FRAMES)
+    return sum(smallest_8n1_geq(min(step, n_out - start) + 4) for start in range(0, n_out, step))
+
+
+def target_dims(w0, h0, variant, scale=4):
+    """
+    Целевой размер кадра варианта (как compute_scaled_and_target_dims точки входа)
+    
+    Args:
+        w0: Ширина исходника
+        h0: Высота исходника
+        variant: 'v1.1_full', 'full' или 'tiny'
+        scale: Масштаб апскейла
+    
+    Returns:
+        (tW, tH) или None, если вариант такой кадр не обработает
+    """
+    multiple = 128
+    if variant == 'v1.1_full':
+        # Масштаб ограничен рамкой 2560x1440, округление вверх до 128, если влезает в рамку
+        max_w, max_h = 2560, 1440
+        scale_eff = max(1.0, min(scale, max_w / w0, max_h / h0))
+        sW, sH = int(round(w0 * scale_eff)), int(round(h0 * scale_eff))
+        ceil_w = max(multiple, ((sW + multiple - 1) // multiple) * multiple)
+        ceil_h = max(multiple, ((sH + multiple - 1) // multiple) * multiple)
+        if ceil_w <= max_w and ceil_h <= max_h:
+            return ceil_w, ceil_h
+        return (
+            min(max(multiple, (sW // multiple) * multiple), max_w),
+            min(max(multiple, (sH // multiple) * multiple), max_h),
         )
-        duration = result.stdout.strip()
-        if duration and duration != 'N/A':
-            return float(duration)
-        return None
-    except (subprocess.CalledProcessError, FileNotFoundError, ValueError):
-        return None
+    if variant == 'full':
+        # Целый масштаб, кэп длинной стороны FLASHVSR_MAX_LONG (0 — без кэпа), округление вниз
+        sW, sH = w0 * scale, h0 * scale
+        if FULL_MAX_LONG > 0 and max(sW, sH) > FULL_MAX_LONG:
+            k = FULL_MAX_LONG / max(sW, sH)
+            sW, sH = int(round(sW * k)), int(round(sH * k))
+        return max(multiple, (sW // multiple) * multiple), max(multiple, (sH // multiple) * multiple)
+    # tiny: кэп длинной стороны FLASHVSR_MAX_LONG (по умолчанию 1536), округление вниз
+    sW, sH = int(round(w0 * scale)), int(round(h0 * scale))
+    if max(sW, sH) > TINY_MAX_LONG:
+        eff_scale = TINY_MAX_LONG / max(w0, h0)
+        sW, sH = int(round(w0 * eff_scale)), int(round(h0 * eff_scale))
+    tW, tH = (sW // multiple) * multiple, (sH // multiple) * multiple
+    return (tW, tH) if tW and tH else None
+
+
+def load_throughput(path=THROUGHPUT_FILE):
+    """
+    Калибровка скорости по вариантам
+    
+    Args:
+        path: Путь к flashvsr_throughput.json
+    
+    Returns:
+        Словарь {вариант: {'mpf_per_s', 'device', ...}} (пустой, если калибровки нет)
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {variant: entry for variant, entry in data.items() if isinstance(entry, dict) and entry.get('mpf_per_s')}
+
+
+def forecast_directory(conn, directory_path):
+    """
+    Прогноз стоимости FlashVSR для папки по данным каталога (папка должна быть просканирована)
+    
+    Args:
+        conn: Соединение каталога
+        directory_path: Путь к директории
+    
+    Returns:
+        Словарь: frames — кадров в исходниках, resolutions — Counter исходных размеров,
+        unknown — файлов без размеров или числа кадров,
+        variants — {вариант: {'mpf': MP-кадров на выходе, 'targets': Counter целевых размеров, 'skipped': файлов}}
+    """
+    forecast = {
+        'frames': 0,
+        'resolutions': Counter(),
+        'unknown': 0,
+        'variants': {variant: {'mpf': 0.0, 'targets': Counter(), 'skipped': 0} for variant in VARIANTS},
+    }
+    for row in folder_files(conn, directory_path):
+        total = row['nb_frames']
+        if not total and row['duration'] and row['fps']:
+            total = int(round(row['duration'] * row['fps']))
+        if not row['width'] or not row['height'] or not total:
+            forecast['unknown'] += 1
+            continue
+        forecast['frames'] += total
+        forecast['resolutions'][(row['width'], row['height'])] += 1
+        for variant, acc in forecast['variants'].items():
+            dims = target_dims(row['width'], row['height'], variant)
+            if dims is None:
+                acc['skipped'] += 1
+                continue
+            tW, tH = dims
+            # Та же мера, что plan_cost в точке входа: выходные мегапиксель-кадры
+            acc['mpf'] += tW * tH * pipeline_frames(total, variant) / 1e6
+            acc['targets'][dims] += 1
+    return forecast
+
+
+def format_histogram(counter, limit=5):
+    """Строка 'ШxВ ×N, ...' для самых частых размеров"""
+    items = [f"{w}x{h} ×{n}" for (w, h), n in counter.most_common(limit)]
+    if len(counter) > limit:
+        items.append(f"ещё {len(counter) - limit}")
+    return ", ".join(items) if items else "-"
+
+
+def print_forecast(forecast, throughput, indent="   "):
+    """
+    Печатает прогноз по вариантам: MP-кадры, целевые размеры и время по калибровке
+    
+    Args:
+        forecast: Результат forecast_directory (или сумма по папкам)
+        throughput: Результат load_throughput
+        indent: Отступ строк
+    """
+    print(f"{indent}Кадров: {forecast['frames']}")
+    if forecast['resolutions']:
+        print(f"{indent}Разрешения: {format_histogram(forecast['resolutions'])}")
+    if forecast['unknown']:
+        print(f"{indent}Предупреждение: нет размеров или числа кадров для {forecast['unknown']} файлов")
+    print(f"{indent}Прогноз FlashVSR:")
+    for variant, acc in forecast['variants'].items():
+        line = f"{indent}   {variant}: {acc['mpf']:.1f} MP-кадров"
+        calibration = throughput.get(variant)
+        if calibration:
+            seconds = acc['mpf'] / calibration['mpf_per_s']
+            line += (
+                f", ~{format_duration(seconds)} "
+                f"({calibration['mpf_per_s']} MP-кадров/с, {calibration.get('device', '?')})"
+            )
+        elif variant in BENCH_VARIANTS:
+            line += ", время: нет калибровки (запустите --bench)"
+        else:
+            line += ", время: не откалиброван (у варианта нет --bench)"
+        print(line)
+        if acc['targets']:
+            print(f"{indent}      цели: {format_histogram(acc['targets'], 3)}")
+        if acc['skipped']:
+            print(f"{indent}      не обработает файлов: {acc['skipped']}")
+
+
+def merge_forecast(total, forecast):
+    """Добавляет прогноз папки к общему"""
+    total['frames'] += forecast['frames']
+    total['resolutions'] += forecast['resolutions']
+    total['unknown'] += forecast['unknown']
+    for variant, acc in forecast['variants'].items():
+        total['variants'][variant]['mpf'] += acc['mpf']
+        total['variants'][variant]['targets'] += acc['targets']
+        total['variants'][variant]['skipped'] += acc['skipped']
 
 
 def format_duration(seconds):
@@ -95,7 +270,7 @@ def analyze_directory(directory_path):
         directory_path: Путь к директории
     
     Returns:
-        Словарь со статистикой: count, total_duration, total_size
+        Словарь со статистикой: count, total_duration, total_size и прогноз FlashVSR (forecast)
     """
     dir_path = Path(directory_path)
     if not dir_path.exists():
@@ -109,23 +284,14 @@ def analyze_directory(directory_path):
         'files_without_duration': 0
     }
     
-    # Находим все MP4 файлы
-    mp4_files = sorted(dir_path.glob('*.mp4'))
-    
-    for video_file in mp4_files:
-        stats['count'] += 1
-        
-        # Получаем размер файла
-        file_size = video_file.stat().st_size
-        stats['total_size'] += file_size
-        
-        # Получаем длительность
-        duration = get_video_duration(video_file)
-        if duration is not None:
-            stats['total_duration'] += duration
-            stats['files_with_duration'] += 1
-        else:
-            stats['files_without_duration'] += 1
+    # Каталог досканирует новые и изменённые MP4 файлы (длительность из заголовка, без ffprobe),
+    # итоги считаются запросом по индексу
+    with closing(open_catalog()) as conn:
+        scan_folder(conn, dir_path, fast=True)
+        for row in folder_totals(conn, dir_path):
+            for key in stats:
+                stats[key] = row[key]
+        stats['forecast'] = forecast_directory(conn, dir_path)
     
     return stats
 
@@ -145,15 +311,26 @@ def main():
     print()
     
     # Проверка наличия ffprobe
-    try:
-        subprocess.run(['ffprobe', '-version'], 
-                      capture_output=True, 
-                      check=True)
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    if shutil.which('ffprobe') is None:
         print("Предупреждение: ffprobe не найден, длительность будет недоступна")
         print()
     
+    # Калибровка скорости FlashVSR для прогноза времени
+    throughput = load_throughput()
+    if throughput:
+        print(f"Калибровка FlashVSR: {THROUGHPUT_FILE} ({', '.join(throughput)})")
+    else:
+        print(f"Калибровка FlashVSR не найдена ({THROUGHPUT_FILE}): прогноз только в MP-кадрах")
+        print("   Замер: python infer_flashvsr_v1.1_full_modified.py --bench")
+    print()
+    
     # Общая статистика
+    total_forecast = {
+        'frames': 0,
+        'resolutions': Counter(),
+        'unknown': 0,
+        'variants': {variant: {'mpf': 0.0, 'targets': Counter(), 'skipped': 0} for variant in VARIANTS},
+    }
     total_stats = {
         'count': 0,
         'total_duration': 0.0,
@@ -188,6 +365,8 @@ def main():
         if stats['files_without_duration'] > 0:
             print(f"   Предупреждение: Не удалось определить длительность для {stats['files_without_duration']} файлов")
         
+        print_forecast(stats['forecast'], throughput)
+        merge_forecast(total_forecast, stats['forecast'])
         print()
         
         # Добавляем к общей статистике
@@ -208,6 +387,7 @@ def main():
     if total_stats['files_without_duration'] > 0:
         print(f"Предупреждение: Не удалось определить длительность для {total_stats['files_without_duration']} файлов из {total_stats['count']}")
     
+    print_forecast(total_forecast, throughput, indent="")
     print("=" * 70)
 
 
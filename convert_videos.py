@@ -7,8 +7,17 @@
 import os
 import subprocess
 import sys
+from contextlib import closing
 from pathlib import Path
 
+from media_catalog import find_files, open_catalog, probe_folder, scan_folder
+from probe_videos import probe_file
+from transcode_pool import run_pool
+
+
+# Лестница разрешений: тег в имени файла и размер; переопределяется CONVERT_RUNGS
+DEFAULT_RUNGS = "res480:624x480,res360:468x360"
+
 
 def check_ffmpeg():
     """Проверяет наличие ffmpeg в системе"""
@@ -22,18 +31,15 @@ def check_ffmpeg():
 
 
 def find_res720_files(directory):
-    """Находит все MP4 файлы с 'res720' в имени"""
+    """Находит все MP4 файлы с 'res720' в имени (по каталогу, после инкрементального сканирования)"""
     directory_path = Path(directory)
     if not directory_path.exists():
         print(f"❌ Ошибка: Папка '{directory}' не существует!")
         return []
     
-    files = []
-    for file in directory_path.glob('*.mp4'):
-        if 'res720' in file.name:
-            files.append(file)
-    
-    return sorted(files)
+    with closing(open_catalog()) as conn:
+        scan_folder(conn, directory_path)
+        return find_files(conn, directory_path, 'res720')
 
 
 def map_codec_name(codec_name):
@@ -57,148 +63,119 @@ def map_codec_name(codec_name):
     return codec_mapping.get(codec_name.lower(), codec_name)
 
 
-def get_video_info(input_file):
+def get_video_info(input_file, probe=None):
     """
     Определяет параметры видео из исходного файла
     
     Args:
         input_file: Путь к исходному файлу
+        probe: Готовая сводка probe_videos, если файл уже опрошен
     
     Returns:
         Словарь с параметрами: codec, bitrate, fps, profile, level и т.д.
     """
-    info = {}
-    
-    try:
-        # Получаем кодек
-        cmd_codec = [
-            'ffprobe',
-            '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=codec_name',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            str(input_file)
-        ]
-        result = subprocess.run(cmd_codec, capture_output=True, text=True, check=True)
-        info['codec'] = result.stdout.strip() or None
-        
-        # Получаем битрейт
-        cmd_bitrate = [
-            'ffprobe',
-            '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=bit_rate',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            str(input_file)
-        ]
-        result = subprocess.run(cmd_bitrate, capture_output=True, text=True, check=True)
-        bitrate = result.stdout.strip()
-        info['bitrate'] = bitrate if bitrate and bitrate != 'N/A' else None
-        
-        # Получаем FPS
-        cmd_fps = [
-            'ffprobe',
-            '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=r_frame_rate',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            str(input_file)
-        ]
-        result = subprocess.run(cmd_fps, capture_output=True, text=True, check=True)
-        fps_str = result.stdout.strip()
-        if fps_str and '/' in fps_str:
-            num, den = map(int, fps_str.split('/'))
-            info['fps'] = num / den if den > 0 else None
-        else:
-            info['fps'] = None
-        
-        # Получаем профиль и уровень для H.264/H.265
-        cmd_profile = [
-            'ffprobe',
-            '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=profile,level',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            str(input_file)
-        ]
-        result = subprocess.run(cmd_profile, capture_output=True, text=True, check=True)
-        lines = result.stdout.strip().split('\n')
-        info['profile'] = lines[0] if lines and lines[0] else None
-        info['level'] = lines[1] if len(lines) > 1 and lines[1] else None
-        
-    except (subprocess.CalledProcessError, FileNotFoundError, ValueError):
-        pass
-    
-    return info
+    if probe is None:
+        probe = probe_file(input_file)
+    if not probe:
+        return {}
+    return {key: probe[key] for key in ('codec', 'bitrate', 'fps', 'profile', 'level')}
+
 
+def describe_source(video_info):
+    """Строка с параметрами исходника для вывода: кодек, битрейт, FPS"""
+    source_codec = video_info.get('codec')
+    video_codec = map_codec_name(source_codec) if source_codec else 'libx264'
+    text = f"  📹 Кодек: {source_codec or 'не определен'} → {video_codec}"
+    if video_info.get('bitrate'):
+        text += f" | Битрейт: {video_info['bitrate']} bps"
+    if video_info.get('fps'):
+        text += f" | FPS: {video_info['fps']:.2f}"
+    return text
 
-def convert_video(input_file, output_file, resolution):
+
+def ladder_command(input_file, rungs, video_info, threads=None):
     """
-    Конвертирует видео в указанное разрешение, сохраняя все параметры исходного видео
+    Собирает команду ffmpeg для всех ступеней за одно декодирование:
+    граф фильтров split раздаёт кадры на scale для каждой ступени, у каждой свой выход
     
     Args:
         input_file: Путь к исходному файлу
-        output_file: Путь к выходному файлу
-        resolution: Кортеж (width, height) для разрешения
-    """
-    width, height = resolution
+        rungs: Список (output_file, (width, height)) ступеней, которые нужно создать
+        video_info: Параметры исходного видео (get_video_info)
+        threads: Потоки ffmpeg на файл (делятся между кодировщиками ступеней) или None — на усмотрение ffmpeg
     
-    # Получаем параметры исходного видео
-    video_info = get_video_info(input_file)
+    Returns:
+        Список аргументов ffmpeg
+    """
     source_codec = video_info.get('codec')
     video_codec = map_codec_name(source_codec) if source_codec else 'libx264'
     
-    print(f"  📹 Кодек: {source_codec or 'не определен'} → {video_codec}", end='')
-    if video_info.get('bitrate'):
-        print(f" | Битрейт: {video_info['bitrate']} bps", end='')
-    if video_info.get('fps'):
-        print(f" | FPS: {video_info['fps']:.2f}", end='')
-    print()
-    
-    # Строим команду ffmpeg
-    cmd = [
-        'ffmpeg',
+    # Один вход, split на все ступени, scale на каждой ветке
+    labels = [f"[v{i}]" for i in range(len(rungs))]
+    graph = [f"[0:v:0]split={len(rungs)}{''.join(labels)}"]
+    graph += [f"{label}scale={w}:{h}[o{i}]" for i, (label, (_, (w, h))) in enumerate(zip(labels, rungs))]
+    cmd = ['ffmpeg']
+    if threads:
+        cmd.extend(['-threads', str(threads)])  # Потоки декодера
+    cmd.extend([
         '-i', str(input_file),
-        '-map', '0',  # Копируем все потоки
-        '-vf', f'scale={width}:{height}',  # Меняем только разрешение
-        '-c:v', video_codec,  # Используем тот же кодек видео
-    ]
-    
-    # Сохраняем битрейт если он был определен
-    if video_info.get('bitrate'):
-        cmd.extend(['-b:v', video_info['bitrate']])
-    
-    # Сохраняем FPS если он был определен
-    if video_info.get('fps'):
-        cmd.extend(['-r', str(video_info['fps'])])
+        '-filter_complex', ';'.join(graph),
+    ])
     
-    # Сохраняем профиль и уровень для H.264/H.265
-    if video_info.get('profile') and video_codec in ['libx264', 'libx265']:
-        cmd.extend(['-profile:v', video_info['profile']])
-    if video_info.get('level') and video_codec in ['libx264', 'libx265']:
-        cmd.extend(['-level', video_info['level']])
+    for i, (output_file, _) in enumerate(rungs):
+        cmd.extend([
+            '-map', f'[o{i}]',  # Видео этой ступени
+            '-map', '0:a?',  # Аудио и субтитры как есть
+            '-map', '0:s?',
+            '-c:v', video_codec,  # Используем тот же кодек видео
+        ])
+        if threads:
+            cmd.extend(['-threads', str(max(1, threads // len(rungs)))])  # Потоки кодировщика ступени
+        
+        # Сохраняем битрейт если он был определен
+        if video_info.get('bitrate'):
+            cmd.extend(['-b:v', video_info['bitrate']])
+        
+        # Сохраняем FPS если он был определен
+        if video_info.get('fps'):
+            cmd.extend(['-r', str(video_info['fps'])])
+        
+        # Сохраняем профиль и уровень для H.264/H.265
+        if video_info.get('profile') and video_codec in ['libx264', 'libx265']:
+            cmd.extend(['-profile:v', video_info['profile']])
+        if video_info.get('level') and video_codec in ['libx264', 'libx265']:
+            cmd.extend(['-level', video_info['level']])
+        
+        # Копируем аудио и субтитры без изменений
+        cmd.extend([
+            '-c:a', 'copy',  # Копируем аудио без изменений
+            '-c:s', 'copy',  # Копируем субтитры без изменений
+            '-map_metadata', '0',  # Копируем метаданные
+            '-y',  # Перезаписывать файл если существует
+            str(output_file)
+        ])
+    return cmd
+
+
+def parse_rungs(spec):
+    """
+    Разбирает лестницу разрешений вида "res480:624x480,res360:468x360"
     
-    # Копируем аудио и субтитры без изменений
-    cmd.extend([
-        '-c:a', 'copy',  # Копируем аудио без изменений
-        '-c:s', 'copy',  # Копируем субтитры без изменений
-        '-map_metadata', '0',  # Копируем метаданные
-        '-y',  # Перезаписывать файл если существует
-        str(output_file)
-    ])
+    Args:
+        spec: Строка ступеней тег:ШxВ через запятую
     
-    try:
-        print(f"  ⏳ Конвертация в {width}x{height}...")
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"  ❌ Ошибка при конвертации: {e.stderr}")
-        return False
+    Returns:
+        Список (тег, (width, height))
+    """
+    rungs = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        tag, size = item.split(':', 1)
+        width, height = size.lower().split('x')
+        rungs.append((tag.strip(), (int(width), int(height))))
+    return rungs
 
 
 def generate_output_filename(input_file, resolution_tag):
@@ -250,21 +227,25 @@ def main():
         print(f"   - {file.name}")
     print()
     
+    # Параметры всех файлов из каталога: ffprobe уже запускался только для новых и изменённых
+    probes = probe_folder(convert_dir, files_to_convert)
+    
     # Разрешения для конвертации
-    resolutions = [
-        ('res480', (624, 480)),
-        ('res360', (468, 360))
-    ]
+    resolutions = parse_rungs(os.environ.get("CONVERT_RUNGS", DEFAULT_RUNGS))
+    print(f"📐 Ступени: {', '.join(f'{tag} {w}x{h}' for tag, (w, h) in resolutions)}")
+    print()
     
-    # Конвертация каждого файла
+    # Подготовка заданий: для каждого файла — недостающие ступени
     total_files = len(files_to_convert)
     successful_conversions = 0
+    tasks = []
     
     for idx, input_file in enumerate(files_to_convert, 1):
         print(f"[{idx}/{total_files}] Обработка: {input_file.name}")
         
-        file_success = True
+        video_info = get_video_info(input_file, probes[input_file] or {})
         
+        rungs = []
         for resolution_tag, resolution in resolutions:
             output_file = generate_output_filename(input_file, resolution_tag)
             
@@ -272,18 +253,30 @@ def main():
             if output_file.exists():
                 print(f"  ⚠️  Файл {output_file.name} уже существует, пропускаем...")
                 continue
-            
-            if convert_video(input_file, output_file, resolution):
-                print(f"  ✅ Создан: {output_file.name}")
-            else:
-                print(f"  ❌ Не удалось создать: {output_file.name}")
-                file_success = False
+            rungs.append((output_file, resolution))
         
-        if file_success:
+        # Все недостающие ступени — за одно декодирование исходника
+        if rungs:
+            print(describe_source(video_info))
+            print(f"  ⏳ В очередь: {', '.join(output_file.name for output_file, _ in rungs)}")
+            tasks.append({
+                'name': input_file.name,
+                'size': input_file.stat().st_size,
+                'command': lambda threads, f=input_file, r=rungs, v=video_info: ladder_command(f, r, v, threads),
+                'outputs': [output_file for output_file, _ in rungs],
+            })
+        else:
             successful_conversions += 1
         
         print()
     
+    # Конвертация: несколько ffmpeg одновременно, ядра поделены между ними
+    if tasks:
+        print("⏳ Конвертация...")
+        run_pool(tasks)
+        successful_conversions += sum(1 for task in tasks if task['ok'])
+        print()
+    
     # Итоговая статистика
     print("=" * 60)
     print("📊 Итоги конвертации:")
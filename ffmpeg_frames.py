@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Общее чтение кадров через пайп ffmpeg для точек входа FlashVSR (infer_flashvsr_v1.1_full_modified, tiny)
+Декодер отдаёт сырые кадры нужного формата прямо в stdout; фильтры (кроп, ресайз) работают внутри ffmpeg.
+Для чанков одного клипа FFmpegReader держит один пайп: следующий чанк читается дальше с текущего места,
+а не декодирует клип заново с начала
+"""
+
+import subprocess
+
+from PIL import Image
+
+
+def ffmpeg_exe():
+    """Бинарник ffmpeg: из imageio-ffmpeg (уже стоит как зависимость imageio), иначе системный"""
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return "ffmpeg"
+
+
+class FFmpegReader:
+    """
+    Один пайп ffmpeg на клип для запросов с растущими индексами (чанки по порядку).
+    Запрос назад, с другими фильтрами или форматом перезапускает декодер с нужного кадра
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: Путь к видео
+        """
+        self.path = path
+        self.proc = None
+        self.key = None
+        self.pos = -1
+        self.buf = None
+
+    def _start(self, key, start):
+        self.close()
+        vf, _, pix_fmt = key
+        vf = f"trim=start_frame={start},setpts=PTS-STARTPTS,{vf}"
+        cmd = [ffmpeg_exe(), '-v', 'error', '-i', self.path, '-vf', vf, '-f', 'rawvideo', '-pix_fmt', pix_fmt, '-']
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.key, self.pos, self.buf = key, start - 1, None
+
+    def frames(self, vf, frame_bytes, indices, pix_fmt='rgb24'):
+        """
+        Сырые кадры по индексам; аргументы как у iter_ffmpeg_raw
+
+        Returns:
+            Генератор bytes по одному на индекс
+        """
+        key, start = (vf, frame_bytes, pix_fmt), min(indices)
+        if self.proc is None or key != self.key or start < self.pos or (start == self.pos and self.buf is None):
+            self._start(key, start)
+        try:
+            for i in indices:
+                while self.pos < i:
+                    self.buf = self.proc.stdout.read(frame_bytes)
+                    if len(self.buf) < frame_bytes:
+                        raise RuntimeError(f"ffmpeg returned only {self.pos + 1} frames from {self.path}")
+                    self.pos += 1
+                yield self.buf
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """Останавливает декодер"""
+        if self.proc is not None:
+            self.proc.stdout.close()
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+
+def iter_ffmpeg_raw(path, vf, frame_bytes, indices, pix_fmt='rgb24', reader=None):
+    """
+    Сырые кадры из пайпа ffmpeg; декодируется только диапазон [min, max] индексов
+
+    Args:
+        path: Путь к видео
+        vf: Цепочка фильтров после обрезки по индексам
+        frame_bytes: Размер одного кадра в байтах после фильтров
+        indices: Неубывающие индексы кадров; повтор индекса отдаёт тот же буфер без повторного чтения
+        pix_fmt: Формат пикселей на выходе (rgb24, yuv420p, ...)
+        reader: FFmpegReader клипа — читать через его пайп вместо отдельного процесса
+
+    Returns:
+        Генератор bytes по одному на индекс
+    """
+    if reader is not None:
+        yield from reader.frames(vf, frame_bytes, indices, pix_fmt)
+        return
+    start, stop = min(indices), max(indices) + 1
+    vf = f"trim=start_frame={start}:end_frame={stop},setpts=PTS-STARTPTS,{vf}"
+    cmd = [ffmpeg_exe(), '-v', 'error', '-i', path, '-vf', vf, '-frames:v', str(stop - start),
+           '-f', 'rawvideo', '-pix_fmt', pix_fmt, '-']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        pos, buf = start - 1, None
+        for i in indices:
+            while pos < i:
+                buf = proc.stdout.read(frame_bytes)
+                if len(buf) < frame_bytes:
+                    raise RuntimeError(f"ffmpeg returned only {pos + 1 - start} frames from {path}")
+                pos += 1
+            yield buf
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+
+def iter_ffmpeg_frames(path, vf, w, h, indices, reader=None):
+    """
+    Кадры rgb24 размера w x h из пайпа ffmpeg как PIL-изображения
+
+    Args:
+        path: Путь к видео
+        vf: Цепочка фильтров, дающая кадры w x h
+        w: Ширина кадра на выходе фильтров
+        h: Высота кадра на выходе фильтров
+        indices: Неубывающие индексы кадров
+        reader: FFmpegReader клипа (см. iter_ffmpeg_raw)
+
+    Returns:
+        Генератор Image; для повторного индекса — тот же объект
+    """
+    last_buf, img = None, None
+    for buf in iter_ffmpeg_raw(path, vf, w * h * 3, indices, reader=reader):
+        if buf is not last_buf:
+            img, last_buf = Image.frombytes('RGB', (w, h), buf), buf
+        yield img
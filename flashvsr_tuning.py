@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Таблица sparse_ratio/local_range по корзинам выходного разрешения для точек входа FlashVSR (full, tiny)
+Формат файла — как у режима --tune в infer_flashvsr_v1.1_full_modified.py: {вариант: {корзина: {...}}}.
+Модуль без torch: таблица читается до загрузки модели
+"""
+
+import json
+import os
+
+
+TUNING_FILE = os.environ.get("FLASHVSR_TUNING_FILE", "./flashvsr_tuning.json")
+
+
+def tuned_params(variant, tw, th, sparse_ratio=2.0, local_range=11, step=256, path=TUNING_FILE):
+    """
+    Параметры разреженного внимания для выхода tw x th из раздела своего варианта.
+    Разделы других вариантов не подставляются: они подобраны на других весах
+
+    Args:
+        variant: Раздел таблицы (full, tiny)
+        tw: Ширина выхода
+        th: Высота выхода
+        sparse_ratio: Значение без строки в таблице
+        local_range: Значение без строки в таблице
+        step: Шаг корзины по длинной стороне выхода
+        path: Путь к таблице
+
+    Returns:
+        Кортеж (sparse_ratio, local_range)
+    """
+    bucket = str(-(-max(tw, th) // step) * step)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f).get(variant, {}).get(bucket, {})
+    except (OSError, ValueError, AttributeError):
+        entry = {}
+    return float(entry.get('sparse_ratio', sparse_ratio)), int(entry.get('local_range', local_range))
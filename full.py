@@ -11,10 +11,14 @@ from einops import rearrange
 
 from diffsynth import ModelManager, FlashVSRFullPipeline
 from utils.utils import Buffer_LQ4x_Proj
+from flashvsr_tuning import tuned_params
 
 # Глобальный кэп по длинной стороне итогового HR (кратно 128);
 # 0 или отсутствие переменной — кэп выключен
 MAX_LONG = int(os.environ.get("FLASHVSR_MAX_LONG", "0"))
+# Раздел таблицы sparse_ratio/local_range (flashvsr_tuning.py); своего --tune у варианта нет,
+# раздел заполняется вручную, без строки для корзины — 2.0 и 11
+VARIANT = "full"
 
 def tensor2video(frames: torch.Tensor):
     frames = rearrange(frames, "C T H W -> T H W C")
@@ -208,14 +212,15 @@ def main():
         except Exception as e:
             print(f"[Error] {name}: {e}")
             continue
+        sr, lr = tuned_params(VARIANT, tw, th, sparse_ratio, 11)
 
         video = pipe(
             prompt="", negative_prompt="", cfg_scale=1.0, num_inference_steps=1, seed=seed,
             tiled=False, # отключаем тайлинг по просьбе пользователя
             LQ_video=LQ, num_frames=F, height=th, width=tw, is_full_block=False, if_buffer=True,
-            topk_ratio=sparse_ratio*768*1280/(th*tw),
+            topk_ratio=sr*768*1280/(th*tw),
             kv_ratio=3.0,
-            local_range=11,
+            local_range=lr,
             color_fix = True,
         )
         video = tensor2video(video)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, re, time, sys
+import os, re, time, sys, json, shutil, struct, subprocess
 import numpy as np
 from PIL import Image
 import imageio
@@ -9,8 +9,77 @@ from tqdm import tqdm
 import torch
 from einops import rearrange
 
-from diffsynth import ModelManager, FlashVSRFullPipeline
-from utils.utils import Causal_LQ4x_Proj
+from ffmpeg_frames import FFmpegReader, ffmpeg_exe, iter_ffmpeg_frames, iter_ffmpeg_raw
+from probe_videos import probe_file
+
+# Длинные клипы обрабатываются чанками по столько исходных кадров (приводится к 8n-3),
+# готовые чанки сохраняются на диск и переживают падение процесса; 0 — клип целиком
+CHUNK_FRAMES = int(os.environ.get("FLASHVSR_CHUNK_FRAMES", "0"))
+# Поиск чёрных полос (letterbox/pillarbox): полосы обрезаются до апскейла и дорисовываются на выходе
+CROP_BARS = os.environ.get("FLASHVSR_CROP_BARS", "0") == "1"
+# Порог дедупликации кадров (средняя разница миниатюр, 0..255): <0 — выключено, 0 — только точные повторы
+DEDUP_THRESH = float(os.environ.get("FLASHVSR_DEDUP", "-1"))
+# Порог склейки сцен (расстояние гистограмм соседних кадров, 0..1): <0 — выключено;
+# сцены обрабатываются как независимые сегменты и склеиваются по порядку
+SCENE_CUT = float(os.environ.get("FLASHVSR_SCENE_CUT", "-1"))
+MIN_SCENE_FRAMES = 17
+# 1 — не терять хвостовые кадры: добивать до следующего 8n+1 повтором последнего и обрезать выход;
+# 0 — как раньше, до 7 последних кадров отбрасываются
+KEEP_ALL_FRAMES = os.environ.get("FLASHVSR_KEEP_ALL_FRAMES", "0") == "1"
+# Источник кадров для видео: imageio (полный кадр + PIL), ffmpeg (кроп/скейл прямо в пайпе декодера,
+# в Python попадают уже кадры целевого размера) или yuv (сырые плоскости yuv420p, конверсия и ресайз на устройстве)
+FRAME_SOURCE = os.environ.get("FLASHVSR_FRAME_SOURCE", "imageio")
+# Каталог для дискового хранилища кадров (memmap uint8 F H W 3): декодер заполняет его один раз,
+# дальше все проходы и чанки читают срезы без копий; пусто — выключено
+FRAME_STORE = os.environ.get("FLASHVSR_FRAME_STORE", "")
+# 1 — не удалять файл хранилища после сохранения выхода (по умолчанию удаляется)
+KEEP_FRAME_STORE = os.environ.get("FLASHVSR_KEEP_FRAME_STORE", "0") == "1"
+FRAME_STORE_MAGIC = b"FVSRU8v1"
+FRAME_STORE_HEADER = 64
+# Устройство процесса (cuda, cuda:1, cpu); launch_flashvsr.py запускает по воркеру на устройство
+DEVICE = os.environ.get("FLASHVSR_DEVICE", "cuda")
+# 1 — вместо модели заглушка, возвращающая вход (проверка планирования и воркеров без GPU и весов)
+STUB_PIPELINE = os.environ.get("FLASHVSR_STUB_PIPELINE", "0") == "1"
+# Порядок входов: list — как заданы; shape — группами по (tW, tH, корзина F), чтобы кэш аллокатора
+# переиспользовался; sjf — то же, но короткие группы/клипы первыми; deadline — по срокам из FLASHVSR_DEADLINES
+SCHEDULE = os.environ.get("FLASHVSR_SCHEDULE", "shape")
+DEADLINES = os.environ.get("FLASHVSR_DEADLINES", "")  # JSON {вход или имя файла: ISO-время или unix time}
+FRAME_BUCKET = 32
+# Сколько клипов одинаковой формы (F, tH, tW) упаковывать в один вызов пайплайна; 1 — по одному
+BATCH = int(os.environ.get("FLASHVSR_BATCH", "1"))
+# Калибровка пропускной способности (MP-кадров/с), пишется режимом --bench
+THROUGHPUT_FILE = os.environ.get("FLASHVSR_THROUGHPUT_FILE", "./flashvsr_throughput.json")
+VARIANT = "v1.1_full"
+# Таблица sparse_ratio/local_range по корзинам выходного разрешения (заполняется режимом --tune);
+# FLASHVSR_SPARSE_RATIO / FLASHVSR_LOCAL_RANGE перекрывают таблицу
+TUNING_FILE = os.environ.get("FLASHVSR_TUNING_FILE", "./flashvsr_tuning.json")
+SPARSE_RATIO = os.environ.get("FLASHVSR_SPARSE_RATIO", "")
+LOCAL_RANGE = os.environ.get("FLASHVSR_LOCAL_RANGE", "")
+DEFAULT_SPARSE_RATIO, DEFAULT_LOCAL_RANGE = 2.0, 9
+RES_BUCKET = 256  # шаг корзины по длинной стороне выхода
+TUNE_FRAMES = int(os.environ.get("FLASHVSR_TUNE_FRAMES", "33"))
+TUNE_MIN_PSNR = float(os.environ.get("FLASHVSR_TUNE_MIN_PSNR", "35"))
+# Сколько параметров DiT держать на устройстве: all (по умолчанию) — весь, auto — сколько влезет в свободную
+# память за вычетом VAE, буферов LQ/выхода и запаса на активации, число (например 4e9) — столько параметров;
+# остальные слои выгружаются на CPU и подгружаются на время прохода
+DIT_PERSISTENT = os.environ.get("FLASHVSR_DIT_PERSISTENT", "all")
+DIT_HEADROOM_GB = float(os.environ.get("FLASHVSR_DIT_HEADROOM_GB", "6"))
+# Буферы LQ+выхода самого крупного входа партии в байтах; задаёт launch_flashvsr.py по планам --plan,
+# чтобы воркер с auto знал их до первого задания
+BUFFER_BYTES = int(os.environ.get("FLASHVSR_BUFFER_BYTES", "0"))
+# Хранение весов Linear-слоёв DiT: bf16 (по умолчанию), int8 или fp8 (e4m3) с масштабом на выходной канал;
+# веса разжимаются в bf16 на время умножения
+DIT_WEIGHTS = os.environ.get("FLASHVSR_DIT_WEIGHTS", "bf16").lower()
+QUANT_MIN_WEIGHTS = 1 << 16   # мелкие слои не трогаем: экономии нет, а точность в них важнее
+QUANT_MIN_PSNR = 35.0
+VRAM_INFO = {}  # итог выбора бюджета, попадает в отчёты и в калибровку --bench
+# Превью: mid (один блок 8n+1 из середины), T (блок с T секунды) или T1-T2 (окно в секундах);
+# кап длинной стороны превью и продолжение полной обработки тем же пайплайном
+PREVIEW = os.environ.get("FLASHVSR_PREVIEW", "")
+PREVIEW_FRAMES = int(os.environ.get("FLASHVSR_PREVIEW_FRAMES", "21"))
+PREVIEW_MAX_LONG = int(os.environ.get("FLASHVSR_PREVIEW_MAX_LONG", "0"))
+PREVIEW_CONTINUE = os.environ.get("FLASHVSR_PREVIEW_CONTINUE", "0") == "1"
+TUNE_GRID = [(sr, lr) for sr in (2.0, 1.75, 1.5, 1.25, 1.0) for lr in (9, 11)]  # первым — базовый 2.0
 
 def tensor2video(frames: torch.Tensor):
     frames = rearrange(frames, "C T H W -> T H W C")
@@ -30,6 +99,9 @@ def list_images_natural(folder: str):
 def largest_8n1_leq(n):  # 8n+1
     return 0 if n < 1 else ((n - 1)//8)*8 + 1
 
+def smallest_8n1_geq(n):  # 8n+1
+    return largest_8n1_leq(n + 7)
+
 def is_video(path): 
     return os.path.isfile(path) and path.lower().endswith(('.mp4','.mov','.avi','.mkv'))
 
@@ -98,126 +170,808 @@ def upscale_then_center_crop(img: Image.Image, sW: int, sH: int, tW: int, tH: in
     l = max(0, (sW - tW) // 2); t = max(0, (sH - tH) // 2)
     return up.crop((l, t, l + tW, t + tH))
 
-def prepare_input_tensor(path: str, scale: int = 4, dtype=torch.bfloat16, device='cuda'):
+def probe_input(path: str):
+    name = os.path.basename(path.rstrip('/'))
     if os.path.isdir(path):
         paths0 = list_images_natural(path)
         if not paths0:
             raise FileNotFoundError(f"No images in {path}")
         with Image.open(paths0[0]) as _img0:
             w0, h0 = _img0.size
-        N0 = len(paths0)
-        print(f"[{os.path.basename(path)}] Original Resolution: {w0}x{h0} | Original Frames: {N0}")
-
-        sW, sH, tW, tH, scale_eff = compute_scaled_and_target_dims(w0, h0, scale=scale, multiple=128)
-        print(
-            f"[{os.path.basename(path)}] Scaled Resolution (x{scale_eff:.2f}): "
-            f"{sW}x{sH} -> Target (128-multiple): {tW}x{tH}"
-        )
-
-        paths = paths0 + [paths0[-1]] * 4
-        F = largest_8n1_leq(len(paths))
-        if F == 0:
-            raise RuntimeError(f"Not enough frames after padding in {path}. Got {len(paths)}.")
-        paths = paths[:F]
-        print(f"[{os.path.basename(path)}] Target Frames (8n-3): {F-4}")
-
-        frames = []
-        for p in paths:
-            with Image.open(p).convert('RGB') as img:
-                img_out = upscale_then_center_crop(img, sW=sW, sH=sH, tW=tW, tH=tH)   
-            frames.append(pil_to_tensor_neg1_1(img_out, dtype, device))             
-        vid = torch.stack(frames, 0).permute(1,0,2,3).unsqueeze(0)             
-        fps = 30
-        return vid, tH, tW, F, fps
+        return {'path': path, 'name': name, 'kind': 'images', 'paths': paths0,
+                'w0': w0, 'h0': h0, 'total': len(paths0), 'fps': 30}
 
     if is_video(path):
         rdr = imageio.get_reader(path)
-        first = Image.fromarray(rdr.get_data(0)).convert('RGB')
-        w0, h0 = first.size
-
-        meta = {}
         try:
-            meta = rdr.get_meta_data()
-        except Exception:
-            pass
-        fps_val = meta.get('fps', 30)
-        fps = int(round(fps_val)) if isinstance(fps_val, (int, float)) else 30
-
-        def count_frames(r):
+            meta = {}
             try:
-                nf = meta.get('nframes', None)
-                if isinstance(nf, int) and nf > 0:
-                    return nf
+                meta = rdr.get_meta_data()
             except Exception:
                 pass
-            try:
-                return r.count_frames()
-            except Exception:
-                n = 0
+            # размер берём из метаданных, чтобы не декодировать кадр ради геометрии
+            size = meta.get('size')
+            if isinstance(size, (tuple, list)) and len(size) == 2 and min(size) > 0:
+                w0, h0 = int(size[0]), int(size[1])
+            else:
+                w0, h0 = Image.fromarray(rdr.get_data(0)).size
+            fps_val = meta.get('fps', 30)
+            fps = int(round(fps_val)) if isinstance(fps_val, (int, float)) else 30
+
+            def count_frames(r):
+                try:
+                    nf = meta.get('nframes', None)
+                    if isinstance(nf, int) and nf > 0:
+                        return nf
+                except Exception:
+                    pass
                 try:
-                    while True:
-                        r.get_data(n); n += 1
+                    return r.count_frames()
                 except Exception:
-                    return n
+                    n = 0
+                    try:
+                        while True:
+                            r.get_data(n); n += 1
+                    except Exception:
+                        return n
+
+            total = count_frames(rdr)
+        finally:
+            try:
+                rdr.close()
+            except Exception:
+                pass
 
-        total = count_frames(rdr)
         if total <= 0:
-            rdr.close()
             raise RuntimeError(f"Cannot read frames from {path}")
+        info = {'path': path, 'name': name, 'kind': 'video', 'w0': w0, 'h0': h0, 'total': total, 'fps': fps}
+        # теги цвета нужны только декодеру yuv; для остальных источников лишний ffprobe не запускаем
+        if FRAME_SOURCE == 'yuv':
+            info.update(probe_color(path))
+        return info
+
+    raise ValueError(f"Unsupported input: {path}")
+
+def detect_bars(plan, samples=8, tol=16, min_bar=4):
+    # Полосы = строки/столбцы у края, которые во всех выбранных кадрах совпадают с цветом рамки
+    total = plan['n_read']
+    indices = sorted({int(i) for i in np.linspace(0, total - 1, num=min(samples, total))})
+    store = plan.get('store')
+    frames = store[indices] if store is not None else [np.asarray(img, np.uint8) for img in iter_source_frames(plan, indices)]
+    stack = np.asarray(frames).astype(np.int16)                                        # K H W 3
+    K, H, W, _ = stack.shape
+    edge = np.concatenate([stack[:, 0].reshape(-1, 3), stack[:, -1].reshape(-1, 3),
+                           stack[:, :, 0].reshape(-1, 3), stack[:, :, -1].reshape(-1, 3)])
+    color = np.median(edge, axis=0)
+    live = np.abs(stack - color).max(axis=3) > tol                                   # K H W
+    rows = np.flatnonzero(live.mean(axis=(0, 2)) > 0.01)
+    cols = np.flatnonzero(live.mean(axis=(0, 1)) > 0.01)
+    if rows.size == 0 or cols.size == 0:
+        return None
+    # чётные границы, чтобы не ломать субдискретизацию цвета
+    t, b = (int(rows[0]) // 2) * 2, (int(H - 1 - rows[-1]) // 2) * 2
+    l, r = (int(cols[0]) // 2) * 2, (int(W - 1 - cols[-1]) // 2) * 2
+    t, b, l, r = [v if v >= min_bar else 0 for v in (t, b, l, r)]
+    if not (t or b or l or r) or (W - l - r) < W // 2 or (H - t - b) < H // 2:
+        return None
+    return {'l': l, 't': t, 'r': r, 'b': b, 'color': [int(c) for c in color]}
 
-        print(f"[{os.path.basename(path)}] Original Resolution: {w0}x{h0} | Original Frames: {total} | FPS: {fps}")
+def pad_bars(frames, plan):
+    # Возвращаем полосы: холст того же размера, что и без обрезки полос (frame_dims полного кадра),
+    # контент встаёт туда, где он был бы в апскейле полного кадра; добивка выхода до tW x tH отрезается
+    bars = plan.get('bars')
+    if not bars:
+        return frames
+    sW0, sH0, tW0, tH0, k0 = plan['frame_dims']
+    ox, oy = max(0, (sW0 - tW0) // 2), max(0, (sH0 - tH0) // 2)
+    cx, cy = max(0, (plan['sW'] - plan['tW']) // 2), max(0, (plan['sH'] - plan['tH']) // 2)
+    vw, vh = min(plan['tW'], plan['sW']), min(plan['tH'], plan['sH'])
+    r = k0 / plan['scale_eff']  # контент и полный кадр могли упереться в разные капы
+    x, y = int(round(bars['l'] * k0 + cx * r)) - ox, int(round(bars['t'] * k0 + cy * r)) - oy
+    size = (int(round(vw * r)), int(round(vh * r)))
+    # за пределами апскейла полного кадра — чёрная добивка, как у клипа без обрезки
+    frame_box = (0, 0, min(tW0, sW0 - ox), min(tH0, sH0 - oy))
+    out = []
+    for f in frames:
+        canvas = Image.new('RGB', (tW0, tH0), (0, 0, 0))
+        canvas.paste(tuple(bars['color']), frame_box)
+        content = f.crop((0, 0, vw, vh))
+        canvas.paste(content if content.size == size else content.resize(size, Image.BICUBIC), (x, y))
+        out.append(canvas)
+    return out
 
-        sW, sH, tW, tH, scale_eff = compute_scaled_and_target_dims(w0, h0, scale=scale, multiple=128)
+def plan_input(path: str, scale: int = 4, prepass=True):
+    # План клипа: геометрия и список индексов кадров считаются до декодирования.
+    # prepass=False (превью первого входа) — только выборка кадров для полос, без прохода по всему клипу;
+    # склейки сцен такому плану досчитывает plan_scene_cuts перед полной обработкой
+    plan = probe_input(path)
+    name, w0, h0, total = plan['name'], plan['w0'], plan['h0'], plan['total']
+    if plan['kind'] == 'video':
+        print(f"[{name}] Original Resolution: {w0}x{h0} | Original Frames: {total} | FPS: {plan['fps']}")
+    else:
+        print(f"[{name}] Original Resolution: {w0}x{h0} | Original Frames: {total}")
+
+    # Кадровый план до любого декодирования: оба варианта 8n+1 и их цена
+    F_drop, F_keep = largest_8n1_leq(total + 4), smallest_8n1_geq(total + 4)
+    if F_drop == 0:
+        raise RuntimeError(f"Not enough frames after padding in {path}. Got {total + 4}.")
+    out_drop = max(0, F_drop - 4)
+    print(
+        f"[{name}] Frame plan: drop tail -> F={F_drop}, {out_drop}/{total} frames out (-{total - out_drop}) | "
+        f"keep all -> F={F_keep}, {total}/{total} frames out (+{F_keep - F_drop} pipeline frames) | "
+        f"using: {'keep all' if KEEP_ALL_FRAMES else 'drop tail'}"
+    )
+    idx = chunk_indices(0, total, keep_all=KEEP_ALL_FRAMES)
+    F = len(idx)
+    n_out = target_frames(total)
+    # кадры дальше n_read не попадут ни в пайплайн, ни в предварительные проходы
+    plan.update(F=F, idx=idx, n_out=n_out, n_read=max(idx) + 1)
+    print(f"[{name}] Target Frames: {n_out} (F={F})")
+
+    plan['bars'] = detect_bars(plan) if CROP_BARS else None
+    if plan['bars']:
+        # геометрия выхода — как без обрезки полос, по ней pad_bars собирает кадр
+        plan['frame_dims'] = compute_scaled_and_target_dims(w0, h0, scale=scale, multiple=128)
+        b = plan['bars']
+        w0, h0 = w0 - b['l'] - b['r'], h0 - b['t'] - b['b']
         print(
-            f"[{os.path.basename(path)}] Scaled Resolution (x{scale_eff:.2f}): "
-            f"{sW}x{sH} -> Target (128-multiple): {tW}x{tH}"
+            f"[{name}] Bars: left {b['l']} top {b['t']} right {b['r']} bottom {b['b']} "
+            f"color {b['color']} -> Content: {w0}x{h0}"
         )
+    elif CROP_BARS:
+        print(f"[{name}] Bars: none")
+
+    if prepass:
+        plan_scene_cuts(plan)
+
+    sW, sH, tW, tH, scale_eff = compute_scaled_and_target_dims(w0, h0, scale=scale, multiple=128)
+    print(
+        f"[{name}] Scaled Resolution (x{scale_eff:.2f}): "
+        f"{sW}x{sH} -> Target (128-multiple): {tW}x{tH}"
+    )
+
+    plan.update(sW=sW, sH=sH, tW=tW, tH=tH, scale_eff=scale_eff)
+    return plan
+
+def plan_scene_cuts(plan):
+    # Склейки по миниатюрам всех n_read кадров — полный проход декодера по клипу
+    plan['cuts'] = detect_scene_cuts(plan, SCENE_CUT) if SCENE_CUT >= 0 else []
+    if SCENE_CUT >= 0:
+        print(f"[{plan['name']}] Scene cuts: {plan['cuts'] or 'none'} -> {len(plan['cuts']) + 1} segment(s)")
+    return plan
+
+def open_frame_store(plan, store_dir):
+    # Файл: заголовок FRAME_STORE_HEADER байт (magic, F, H, W, C, размер и mtime источника), затем кадры подряд.
+    # Заголовок пишется последним, поэтому недописанное после сбоя хранилище просто пересоздаётся
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, f"{os.path.splitext(plan['name'])[0]}.u8")
+    st = os.stat(plan['path'])
+    # только кадры [0, n_read): дальше них ни пайплайн, ни предварительные проходы не читают
+    F, H, W = plan['n_read'], plan['h0'], plan['w0']
+    header = struct.pack('<8s4Iqd', FRAME_STORE_MAGIC, F, H, W, 3, st.st_size, st.st_mtime)
+    size = FRAME_STORE_HEADER + F * H * W * 3
+
+    reused = False
+    if os.path.isfile(path) and os.path.getsize(path) == size:
+        with open(path, 'rb') as f:
+            reused = f.read(len(header)) == header
+    if not reused:
+        tmp = path + ".part"
+        mm = np.memmap(tmp, np.uint8, mode='w+', offset=FRAME_STORE_HEADER, shape=(F, H, W, 3))
+        for k, img in enumerate(tqdm(iter_source_frames(plan, range(F)), total=F, desc=f"Decoding {plan['name']}")):
+            mm[k] = np.asarray(img, np.uint8)
+        mm.flush()
+        del mm
+        with open(tmp, 'r+b') as f:
+            f.write(header.ljust(FRAME_STORE_HEADER, b"\0"))
+        os.replace(tmp, path)
+
+    print(f"[{plan['name']}] Frame store: {path} ({size / 2**20:.1f} MB, {'reused' if reused else 'filled'})")
+    # mode='c': страницы подгружаются по мере чтения, запись в массив файл не трогает
+    return np.memmap(path, np.uint8, mode='c', offset=FRAME_STORE_HEADER, shape=(F, H, W, 3))
+
+def attach_frame_store(plan):
+    # Хранилище заполняется, когда клип доходит до обработки; планирование входов его не трогает
+    if FRAME_STORE and plan.get('store') is None:
+        plan['store'] = open_frame_store(plan, FRAME_STORE)
+    return plan
+
+def release_frame_store(plan, delete=True):
+    # После сохранения выхода файл удаляется (если не FLASHVSR_KEEP_FRAME_STORE=1);
+    # после сбоя остаётся, и повторный запуск его переиспользует
+    store = plan.pop('store', None)
+    if store is None:
+        return
+    path = store.filename
+    del store
+    if delete and not KEEP_FRAME_STORE and os.path.isfile(path):
+        os.remove(path)
+        print(f"[{plan['name']}] Frame store removed: {path}")
+
+def iter_source_frames(plan, indices):
+    # Читает только запрошенные индексы; повтор последнего кадра (паддинг) не декодируется заново
+    store = plan.get('store')
+    if store is not None:
+        # Image.fromarray копирует кадр: в памяти процесса по одному кадру, а не весь клип
+        for i in indices:
+            yield Image.fromarray(store[i])
+        return
 
-        idx = list(range(total)) + [total - 1] * 4
-        F = largest_8n1_leq(len(idx))
-        if F == 0:
+    if plan['kind'] == 'images':
+        for i in indices:
+            with Image.open(plan['paths'][i]) as img:
+                yield img.convert('RGB')
+        return
+
+    rdr = imageio.get_reader(plan['path'])
+    try:
+        last_i, last_img = None, None
+        for i in indices:
+            if i != last_i:
+                last_img = Image.fromarray(rdr.get_data(i)).convert('RGB')
+                last_i = i
+            yield last_img
+    finally:
+        try:
             rdr.close()
-            raise RuntimeError(f"Not enough frames after padding in {path}. Got {len(idx)}.")
-        idx = idx[:F]
-        print(f"[{os.path.basename(path)}] Target Frames (8n-3): {F-4}")
+        except Exception:
+            pass
+
+def yuv420_frame_bytes(w, h):
+    return w * h + 2 * ((w + 1) // 2) * ((h + 1) // 2)
+
+YUV_MATRICES = {'bt601': (0.299, 0.114), 'bt709': (0.2126, 0.0722)}  # Kr, Kb
+
+def probe_color(path):
+    # Матрица и диапазон YUV по тегам потока; без тегов — BT.601 limited, как у swscale по умолчанию
+    info = probe_file(path) or {}
+    matrix = 'bt709' if info.get('color_space') == 'bt709' else 'bt601'
+    full_range = info.get('color_range') in ('pc', 'jpeg') or (info.get('pix_fmt') or '').startswith('yuvj')
+    return {'matrix': matrix, 'full_range': full_range}
+
+def yuv_coeffs(matrix):
+    # (V->R, U->G, V->G, U->B) для матрицы с коэффициентами Kr, Kb
+    kr, kb = YUV_MATRICES[matrix]
+    kg = 1.0 - kr - kb
+    return 2.0 * (1.0 - kr), 2.0 * kb * (1.0 - kb) / kg, 2.0 * kr * (1.0 - kr) / kg, 2.0 * (1.0 - kb)
+
+def yuv420_to_rgb(buf: torch.Tensor, w: int, h: int, matrix='bt601', full_range=False):
+    # N x yuv420_frame_bytes uint8 (на любом устройстве) -> N 3 h w float32 в [0, 1];
+    # матрица BT.601/BT.709, диапазон limited (16-235/240) или full; хрома — повтором 2x2
+    n, cw, ch = buf.shape[0], (w + 1) // 2, (h + 1) // 2
+    y = buf[:, :w*h].reshape(n, 1, h, w).float()
+    uv = buf[:, w*h:].reshape(n, 2, ch, cw).float()
+    uv = uv.repeat_interleave(2, dim=2).repeat_interleave(2, dim=3)[:, :, :h, :w]
+    ys, cs = (1.0, 1.0) if full_range else (255.0 / 219.0, 255.0 / 224.0)
+    y = (y - (0.0 if full_range else 16.0)) * ys
+    u, v = (uv[:, :1] - 128.0) * cs, (uv[:, 1:] - 128.0) * cs
+    vr, ug, vg, ub = yuv_coeffs(matrix)
+    rgb = torch.cat([y + vr * v, y - ug * u - vg * v, y + ub * u], 1)
+    return (rgb / 255.0).clamp(0, 1)
+
+def yuv420_to_rgb_reference(buf: np.ndarray, w: int, h: int, matrix='bt601', full_range=False):
+    # Эталон на CPU (numpy, float64, матрица из Kr, Kb): один кадр -> h w 3 uint8
+    cw, ch = (w + 1) // 2, (h + 1) // 2
+    y = buf[:w*h].reshape(h, w).astype(np.float64)
+    u = buf[w*h:w*h + cw*ch].reshape(ch, cw).astype(np.float64)[np.arange(h) // 2][:, np.arange(w) // 2]
+    v = buf[w*h + cw*ch:].reshape(ch, cw).astype(np.float64)[np.arange(h) // 2][:, np.arange(w) // 2]
+    if full_range:
+        yuv = np.stack([y / 255.0, (u - 128) / 255.0, (v - 128) / 255.0], -1)
+    else:
+        yuv = np.stack([(y - 16) / 219.0, (u - 128) / 224.0, (v - 128) / 224.0], -1)
+    kr, kb = YUV_MATRICES[matrix]
+    kg = 1.0 - kr - kb
+    m = np.array([[1.0, 0.0, 2 * (1 - kr)], [1.0, -2 * kb * (1 - kb) / kg, -2 * kr * (1 - kr) / kg], [1.0, 2 * (1 - kb), 0.0]])
+    return np.clip(np.rint(yuv @ m.T * 255.0), 0, 255).astype(np.uint8)
+
+def ffmpeg_yuv_to_rgb(bufs, w, h, matrix, full_range):
+    # Те же кадры через swscale: setparams задаёт матрицу и диапазон, scale переводит в rgb24
+    space, rng = {'bt601': 'smpte170m', 'bt709': 'bt709'}[matrix], 'pc' if full_range else 'tv'
+    cmd = [ffmpeg_exe(), '-v', 'error', '-f', 'rawvideo', '-pix_fmt', 'yuv420p', '-s', f"{w}x{h}", '-i', '-',
+           '-vf', f"setparams=colorspace={space}:range={rng}", '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+    out = subprocess.run(cmd, input=np.ascontiguousarray(bufs).tobytes(), capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.uint8).reshape(len(bufs), h, w, 3)
 
-        frames = []
+def check_yuv_conversion(device='cpu', w=37, h=21, n=4, seed=0):
+    # Точность цвета: yuv420_to_rgb против эталона на случайных плоскостях, на опорных цветах BT.601
+    # и против rgb24 самого ffmpeg для всех матриц и диапазонов (однотонные кадры: апсемплинг хромы не влияет)
+    rng = np.random.default_rng(seed)
+    bufs = rng.integers(16, 241, size=(n, yuv420_frame_bytes(w, h)), dtype=np.uint8)
+    err = 0
+    for matrix in YUV_MATRICES:
+        for full_range in (False, True):
+            got = (yuv420_to_rgb(torch.from_numpy(bufs).to(device), w, h, matrix, full_range) * 255.0).round().to(torch.uint8)
+            got = got.permute(0, 2, 3, 1).cpu().numpy().astype(np.int16)
+            ref = np.stack([yuv420_to_rgb_reference(b, w, h, matrix, full_range) for b in bufs]).astype(np.int16)
+            err = max(err, int(np.abs(got - ref).max()))
+
+    known = {  # (Y, U, V) -> RGB
+        (235, 128, 128): (255, 255, 255), (16, 128, 128): (0, 0, 0),
+        (81, 90, 240): (255, 0, 0), (145, 54, 34): (0, 255, 0), (41, 240, 110): (0, 0, 255),
+    }
+    known_err = 0
+    for (Y, U, V), rgb in known.items():
+        b = np.array([Y] * 4 + [U, V], np.uint8)[None]
+        px = (yuv420_to_rgb(torch.from_numpy(b).to(device), 2, 2)[0, :, 0, 0] * 255.0).round().cpu().numpy()
+        known_err = max(known_err, int(np.abs(px - np.array(rgb)).max()))
+
+    # цвета берутся внутри гаммы: за её пределами swscale по-своему обрезает каналы
+    fw, fh, flat = 16, 8, rng.integers(0, 256, size=(8, 3)).astype(np.float64)
+    ff_err = {}
+    for matrix in YUV_MATRICES:
+        kr, kb = YUV_MATRICES[matrix]
+        luma = flat @ np.array([kr, 1.0 - kr - kb, kb])
+        u, v = (flat[:, 2] - luma) / (2 * (1 - kb)), (flat[:, 0] - luma) / (2 * (1 - kr))
+        for full_range in (False, True):
+            yuv = np.stack([luma, u + 128, v + 128], 1) if full_range else \
+                np.stack([16 + luma * 219 / 255, 128 + u * 224 / 255, 128 + v * 224 / 255], 1)
+            flat_bufs = np.stack([np.repeat(c, [fw * fh, fw * fh // 4, fw * fh // 4]) for c in np.rint(yuv)]).astype(np.uint8)
+            got = (yuv420_to_rgb(torch.from_numpy(flat_bufs).to(device), fw, fh, matrix, full_range) * 255.0).round()
+            got = got.permute(0, 2, 3, 1).cpu().numpy()
+            ref = ffmpeg_yuv_to_rgb(flat_bufs, fw, fh, matrix, full_range)
+            ff_err[f"{matrix}/{'full' if full_range else 'limited'}"] = int(np.abs(got - ref).max())
+
+    ok = err <= 1 and known_err <= 2 and max(ff_err.values()) <= 2
+    print(f"[YUV] device={device} max error vs reference: {err} | vs BT.601 reference colors: {known_err} | "
+          f"vs ffmpeg rgb24: {', '.join(f'{k} {v}' for k, v in ff_err.items())} -> {'OK' if ok else 'FAIL'}")
+    return ok
+
+def iter_target_frames(plan, indices):
+    # Кадры уже в целевом разрешении tW x tH (с обрезанными полосами)
+    sW, sH, tW, tH = plan['sW'], plan['sH'], plan['tW'], plan['tH']
+    bars = plan.get('bars')
+    if FRAME_SOURCE == 'ffmpeg' and plan['kind'] == 'video' and plan.get('store') is None:
+        vf = []
+        if bars:
+            cw, ch = plan['w0'] - bars['l'] - bars['r'], plan['h0'] - bars['t'] - bars['b']
+            vf.append(f"crop={cw}:{ch}:{bars['l']}:{bars['t']}")
+        vf.append(f"scale={sW}:{sH}:flags=bicubic")
+        vf.append(f"crop={min(tW, sW)}:{min(tH, sH)}:{max(0, (sW - tW) // 2)}:{max(0, (sH - tH) // 2)}")
+        if tW > sW or tH > sH:
+            # как PIL crop за границей кадра: чёрное поле справа/снизу
+            vf.append(f"pad={tW}:{tH}:0:0:black")
+        yield from iter_ffmpeg_frames(plan['path'], ",".join(vf), tW, tH, indices, reader=plan.get('ffmpeg_reader'))
+        return
+
+    for img in iter_source_frames(plan, indices):
+        if bars:
+            img = img.crop((bars['l'], bars['t'], img.width - bars['r'], img.height - bars['b']))
+        yield upscale_then_center_crop(img, sW=sW, sH=sH, tW=tW, tH=tH)
+
+def build_lq_tensor_yuv(plan, indices, dtype=torch.bfloat16, device='cuda', batch=16):
+    # Декодер отдаёт yuv420p (1.5 байта/пиксель) в один компактный буфер; YUV->RGB, ресайз и кроп
+    # делаются батчами на устройстве
+    sW, sH, tW, tH = plan['sW'], plan['sH'], plan['tW'], plan['tH']
+    bars = plan.get('bars') or {'l': 0, 't': 0, 'r': 0, 'b': 0}
+    w, h = plan['w0'] - bars['l'] - bars['r'], plan['h0'] - bars['t'] - bars['b']
+    vf = f"crop={w}:{h}:{bars['l']}:{bars['t']}"
+    fb = yuv420_frame_bytes(w, h)
+    buf = np.empty((len(indices), fb), np.uint8)
+    # full range просим как yuvj420p: с yuv420p ffmpeg пересжал бы его в limited
+    matrix, full_range = plan.get('matrix', 'bt601'), plan.get('full_range', False)
+    pix_fmt = 'yuvj420p' if full_range else 'yuv420p'
+    for k, raw in enumerate(iter_ffmpeg_raw(plan['path'], vf, fb, indices, pix_fmt=pix_fmt, reader=plan.get('ffmpeg_reader'))):
+        buf[k] = np.frombuffer(raw, np.uint8)
+
+    l, t = max(0, (sW - tW) // 2), max(0, (sH - tH) // 2)
+    out = []
+    for s in range(0, len(indices), batch):
+        rgb = yuv420_to_rgb(torch.from_numpy(buf[s:s + batch]).to(device), w, h, matrix, full_range)
+        rgb = torch.nn.functional.interpolate(rgb, size=(sH, sW), mode='bicubic', align_corners=False).clamp(0, 1)
+        rgb = rgb[:, :, t:t + tH, l:l + tW]
+        if rgb.shape[-2:] != (tH, tW):
+            rgb = torch.nn.functional.pad(rgb, (0, tW - rgb.shape[-1], 0, tH - rgb.shape[-2]))
+        out.append((rgb * 2.0 - 1.0).to(dtype))
+    return torch.cat(out, 0).permute(1,0,2,3).unsqueeze(0)   # 1 C F H W
+
+def build_lq_tensor(plan, indices, dtype=torch.bfloat16, device='cuda'):
+    if FRAME_SOURCE == 'yuv' and plan['kind'] == 'video' and plan.get('store') is None:
+        return build_lq_tensor_yuv(plan, indices, dtype, device)
+    frames = []
+    for img_out in iter_target_frames(plan, indices):
+        frames.append(pil_to_tensor_neg1_1(img_out, dtype, device))
+    return torch.stack(frames, 0).permute(1,0,2,3).unsqueeze(0)   # 1 C F H W
+
+def prepare_input_tensor(path: str, scale: int = 4, dtype=torch.bfloat16, device='cuda'):
+    plan = plan_input(path, scale=scale)
+    vid = build_lq_tensor(plan, plan['idx'], dtype, device)
+    return vid, plan['tH'], plan['tW'], plan['F'], plan['fps']
+
+def resolution_bucket(tw, th, step=RES_BUCKET):
+    return str(-(-max(tw, th) // step) * step)
+
+_tuning_cache = {}
+_tuning_reported = set()
+
+def load_tuning(path=TUNING_FILE):
+    if path not in _tuning_cache:
         try:
-            for i in idx:
-                img = Image.fromarray(rdr.get_data(i)).convert('RGB')
-                img_out = upscale_then_center_crop(img, sW=sW, sH=sH, tW=tW, tH=tH)
-                frames.append(pil_to_tensor_neg1_1(img_out, dtype, device))
-        finally:
-            try:
-                rdr.close()
-            except Exception:
-                pass
+            with open(path, 'r', encoding='utf-8') as f:
+                _tuning_cache[path] = json.load(f).get(VARIANT, {})
+        except (OSError, ValueError):
+            _tuning_cache[path] = {}
+    return _tuning_cache[path]
 
-        vid = torch.stack(frames, 0).permute(1,0,2,3).unsqueeze(0)   # 1 C F H W
-        return vid, tH, tW, F, fps
+def resolve_tuning(tw, th, sparse_ratio=None, local_range=None):
+    # Явно заданное значение > строка таблицы --tune для корзины разрешения > значение по умолчанию
+    bucket = resolution_bucket(tw, th)
+    entry = load_tuning().get(bucket, {})
+    if sparse_ratio is None:
+        sparse_ratio = float(entry.get('sparse_ratio', DEFAULT_SPARSE_RATIO))
+    if local_range is None:
+        local_range = int(entry.get('local_range', DEFAULT_LOCAL_RANGE))
+    if bucket not in _tuning_reported:
+        _tuning_reported.add(bucket)
+        print(f"[Tuning] {bucket}: sparse_ratio={sparse_ratio} local_range={local_range}"
+              f"{' (table)' if entry else ''}")
+    return sparse_ratio, local_range
 
-    raise ValueError(f"Unsupported input: {path}")
+def run_pipeline(pipe, LQ, F, th, tw, seed=0, sparse_ratio=None, local_range=None):
+    sparse_ratio, local_range = resolve_tuning(tw, th, sparse_ratio, local_range)
+    return pipe(
+        prompt="", negative_prompt="", cfg_scale=1.0, num_inference_steps=1, seed=seed, 
+        tiled=False,# Disable tiling: faster inference but higher VRAM usage. 
+                    # Set to True for lower memory consumption at the cost of speed.
+        LQ_video=LQ, num_frames=F, height=th, width=tw, is_full_block=False, if_buffer=True,
+        topk_ratio=sparse_ratio*768*1280/(th*tw), 
+        kv_ratio=3.0,
+        local_range=local_range, # Recommended: 9 or 11. local_range=9 → sharper details; 11 → more stable results.
+        color_fix = True,
+    )
+
+def iter_thumbnails(plan, indices, thumb_w=64):
+    for img in iter_source_frames(plan, indices):
+        thumb_h = max(1, thumb_w * img.height // img.width)
+        yield np.asarray(img.convert('L').resize((thumb_w, thumb_h), Image.BILINEAR), np.uint8)
+
+def plan_thumbnails(plan):
+    # Миниатюры всех n_read кадров: один проход декодера на клип, общий для склеек и дедупликации
+    if plan.get('thumbs') is None:
+        plan['thumbs'] = np.stack(list(iter_thumbnails(plan, range(plan['n_read']))))  # F h w uint8
+    return plan['thumbs']
+
+def detect_scene_cuts(plan, thresh, bins=32, min_len=MIN_SCENE_FRAMES):
+    # Гистограммы яркости всех кадров одним bincount, расстояние = половина L1 между соседними
+    thumbs = plan_thumbnails(plan).astype(np.int16)                                   # F h w
+    n = thumbs.shape[0]
+    q = (thumbs * bins) >> 8
+    flat = (q + bins * np.arange(n)[:, None, None]).ravel()
+    hist = np.bincount(flat, minlength=bins * n).reshape(n, bins) / float(q[0].size)
+    dist = 0.5 * np.abs(np.diff(hist, axis=0)).sum(axis=1)                            # F-1
+    cuts, last = [], 0
+    for c in (np.flatnonzero(dist > thresh) + 1):
+        if c - last >= min_len and n - c >= min_len:
+            cuts.append(int(c))
+            last = c
+    return cuts
+
+def dedup_frames(plan, indices, thresh):
+    # Кадр — дубликат, если миниатюра почти не отличается от последнего уникального кадра
+    keep, expand, ref = [], [], None
+    thumbs = plan_thumbnails(plan)
+    for i in indices:
+        thumb = thumbs[i].astype(np.int16)
+        if ref is None or np.abs(thumb - ref).mean() > thresh:
+            keep.append(i)
+            ref = thumb
+        expand.append(len(keep) - 1)
+    return keep, expand
+
+def schedule_frames(plan, start, stop, keep_all=KEEP_ALL_FRAMES, thresh=DEDUP_THRESH):
+    # Индексы кадров для пайплайна и раскладка его выхода обратно на исходную шкалу [start, stop);
+    # чанки идут с keep_all=True: их границы уже обрезаны до n_out (см. plan_spans)
+    base = chunk_indices(start, stop, keep_all=keep_all)
+    if thresh < 0:
+        return base, list(range(stop - start))
+
+    # тот же хвост, что без дедупликации: выход только до n_out, уникальные кадры добиваются до 8n+1
+    end = min(stop, plan['n_out'])
+    keep, expand = dedup_frames(plan, range(start, end), thresh)
+    n = len(keep)
+    idx = keep + [keep[-1]] * (smallest_8n1_geq(n + 4) - n)
+    if len(idx) >= len(base):
+        # повторов слишком мало, чтобы сэкономить хоть один блок: обычное расписание
+        idx, expand = base, list(range(stop - start))
+    stats = plan.setdefault('dedup', {'source': 0, 'unique': 0, 'frames': 0, 'baseline': 0})
+    stats['source'] += end - start; stats['unique'] += n
+    stats['frames'] += len(idx); stats['baseline'] += len(base)
+    return idx, expand
+
+def expand_frames(frames, expand):
+    return [frames[j] for j in expand if j < len(frames)]
+
+def report_dedup(plan):
+    stats = plan.get('dedup')
+    if not stats:
+        return
+    saved = 1.0 - stats['frames'] / max(1, stats['baseline'])
+    print(
+        f"[{plan['name']}] Dedup: {stats['unique']}/{stats['source']} unique frames | "
+        f"pipeline frames {stats['frames']} vs {stats['baseline']} ({saved*100:.1f}% saved)"
+    )
+
+def chunk_len_8n3(n):  # 8k-3: вместе с 4 кадрами паддинга даёт 8k+1
+    return max(5, ((n + 3) // 8) * 8 - 3)
+
+def plan_chunks(total, chunk_frames, cuts=None):
+    # Сначала режем по сценам, затем (если задано) каждую сцену — на чанки 8n-3
+    bounds = [0] + list(cuts or []) + [total]
+    chunks = []
+    for a, b in zip(bounds, bounds[1:]):
+        L = chunk_len_8n3(chunk_frames) if chunk_frames > 0 else b - a
+        chunks += [(s, min(s + L, b)) for s in range(a, b, L)]
+    return chunks
+
+def plan_spans(plan, chunk_frames=CHUNK_FRAMES):
+    # Сегменты покрывают только выходные кадры [0, n_out): хвост до 8n+1 отбрасывается один раз на клип,
+    # как без чанков, а не у каждого чанка
+    # Сегменты клипа выполняются подряд в run_chunked; планировщик и launch_flashvsr.py их не видят
+    n_out = plan['n_out']
+    return plan_chunks(n_out, chunk_frames, [c for c in plan.get('cuts') or [] if c < n_out])
+
+def target_frames(total, keep_all=KEEP_ALL_FRAMES):
+    # Сколько кадров будет на выходе клипа: без keep_all хвост сверх 8n+1 отбрасывается
+    return total if keep_all or total < 5 else largest_8n1_leq(total + 4) - 4
+
+def check_chunk_frames(cases=((38, 13, []), (38, 0, [17]), (100, 21, [40]), (9, 5, []), (4, 13, []), (200, 29, [60, 131]))):
+    # Чанки и сцены не теряют кадров: выход по сегментам (F-4 кадра на вызов, как у StubPipeline)
+    # совпадает с выходом клипа целиком при обоих режимах хвоста
+    ok = True
+    for total, chunk_frames, cuts in cases:
+        for keep_all in (False, True):
+            plan = {'total': total, 'cuts': cuts, 'n_out': target_frames(total, keep_all)}
+            idx, expand = schedule_frames(plan, 0, total, keep_all=keep_all, thresh=-1)
+            whole = len(expand_frames(range(max(1, len(idx) - 4)), expand))
+            chunked = 0
+            for s, e in plan_spans(plan, chunk_frames):
+                idx, expand = schedule_frames(plan, s, e, keep_all=True, thresh=-1)
+                chunked += len(expand_frames(range(max(1, len(idx) - 4)), expand))
+            good = whole == chunked == plan['n_out']
+            ok = ok and good
+            print(f"[Chunks] total={total} chunk={chunk_frames} cuts={cuts} keep_all={int(keep_all)}: "
+                  f"whole {whole} | chunked {chunked} -> {'OK' if good else 'FAIL'}")
+    return ok
+
+def chunk_indices(start, stop, keep_all=False):
+    # keep_all: добиваем повтором последнего кадра до следующего 8n+1 вместо отбрасывания хвоста;
+    # меньше 5 кадров без добивки не дали бы ни одного выходного кадра
+    n = stop - start
+    F = smallest_8n1_geq(n + 4) if keep_all or n < 5 else largest_8n1_leq(n + 4)
+    idx = list(range(start, stop)) + [stop - 1] * max(0, F - n)
+    return idx[:F]
+
+def read_journal(journal_path):
+    try:
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_journal(journal_path, journal):
+    tmp = journal_path + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(journal, f, ensure_ascii=False, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, journal_path)
+
+def concat_segments(segments, out_path):
+    # concat demuxer + -c copy: сегменты склеиваются без перекодирования
+    list_path = out_path + ".concat.txt"
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for s in segments:
+            f.write("file '" + os.path.abspath(s).replace("'", "'\\''") + "'\n")
+    tmp_out = out_path + ".part.mp4"
+    cmd = [ffmpeg_exe(), '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+           '-c', 'copy', '-y', tmp_out]
+    try:
+        subprocess.run(cmd, capture_output=True, text=True, check=True)
+        os.replace(tmp_out, out_path)
+    finally:
+        for p in (list_path, tmp_out):
+            if os.path.exists(p):
+                os.remove(p)
+
+def run_chunked(pipe, plan, out_path, seed=0, sparse_ratio=None, local_range=None, dtype=torch.bfloat16, device='cuda', flush=None):
+    # Каждый готовый чанк сразу пишется в свой сегмент и отмечается в журнале;
+    # после падения перезапуск продолжает с первого незавершённого чанка
+    name = plan['name']
+    sparse_ratio, local_range = resolve_tuning(plan['tW'], plan['tH'], sparse_ratio, local_range)
+    work_dir = os.path.join(os.path.dirname(out_path), ".chunks", os.path.splitext(os.path.basename(out_path))[0])
+    journal_path = os.path.join(work_dir, "journal.json")
+    st = os.stat(plan['path'])
+    key = {
+        'source': os.path.abspath(plan['path']), 'size': st.st_size, 'mtime': int(st.st_mtime),
+        'total': plan['total'], 'tW': plan['tW'], 'tH': plan['tH'], 'bars': plan.get('bars'),
+        'chunk_frames': CHUNK_FRAMES, 'cuts': plan.get('cuts'), 'seed': seed, 'sparse_ratio': sparse_ratio, 'dedup': DEDUP_THRESH,
+        'keep_all': KEEP_ALL_FRAMES, 'n_out': plan['n_out'], 'local_range': local_range, 'dit_weights': DIT_WEIGHTS,
+    }
+
+    journal = read_journal(journal_path)
+    if journal is None or journal.get('key') != key:
+        if os.path.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        os.makedirs(work_dir, exist_ok=True)
+        journal = {'key': key, 'chunks': [
+            {'index': i, 'start': s, 'stop': e, 'file': f"seg_{i:05d}.mp4", 'done': False}
+            for i, (s, e) in enumerate(plan_spans(plan))
+        ]}
+        write_journal(journal_path, journal)
+
+    chunks = journal['chunks']
+    # кэш устройства сбрасывается только при смене формы чанка (обычно у последнего чанка и на
+    # склейках сцен); flush вызывающего кода помнит форму предыдущего вызова пайплайна
+    flush = flush or ShapeCacheFlusher(device)
+    done = sum(1 for ch in chunks if ch['done'] and os.path.isfile(os.path.join(work_dir, ch['file'])))
+    print(f"[{name}] Chunks: {len(chunks)} | done: {done}")
+
+    # пайп ffmpeg (FLASHVSR_FRAME_SOURCE=ffmpeg|yuv) один на все чанки: каждый следующий читается с места,
+    # где остановился предыдущий, а не декодирует клип заново с начала
+    plan['ffmpeg_reader'] = FFmpegReader(plan['path']) if plan['kind'] == 'video' else None
+    try:
+        for ch in chunks:
+            seg_path = os.path.join(work_dir, ch['file'])
+            if ch['done'] and os.path.isfile(seg_path):
+                continue
+            idx, expand = schedule_frames(plan, ch['start'], ch['stop'], keep_all=True)
+            print(f"[{name}] Chunk {ch['index']+1}/{len(chunks)}: frames {ch['start']}..{ch['stop']-1} (F={len(idx)})")
+            flush(plan, len(idx))
+            LQ = build_lq_tensor(plan, idx, dtype, device)
+            video = run_pipeline(pipe, LQ, len(idx), plan['tH'], plan['tW'], seed=seed, sparse_ratio=sparse_ratio, local_range=local_range)
+            frames = pad_bars(expand_frames(tensor2video(video), expand), plan)
+            part_path = os.path.join(work_dir, f"seg_{ch['index']:05d}.part.mp4")
+            save_video(frames, part_path, fps=plan['fps'], quality=6)
+            os.replace(part_path, seg_path)
+            ch['done'] = True
+            write_journal(journal_path, journal)
+            del LQ, video
+
+    finally:
+        if plan.get('ffmpeg_reader') is not None:
+            plan['ffmpeg_reader'].close()
+        plan.pop('ffmpeg_reader', None)
+
+    report_dedup(plan)
+    concat_segments([os.path.join(work_dir, ch['file']) for ch in chunks], out_path)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"[{name}] Saved {out_path}")
+
+class StubPipeline:
+    # Заглушка FlashVSR: отдаёт LQ как есть, в том же формате C T H W и с тем же числом кадров F-4;
+    # батч B > 1 возвращается как B C T H W
+    def __call__(self, LQ_video=None, num_frames=None, **kwargs):
+        out = LQ_video[:, :, :max(1, num_frames - 4)].float()
+        return out[0] if out.shape[0] == 1 else out
+
+class QuantLinear(torch.nn.Module):
+    # Linear с весом int8/fp8 и масштабом на выходной канал; веса восстанавливаются на каждом вызове
+    def __init__(self, linear, mode):
+        super().__init__()
+        w = linear.weight.detach().float()
+        qmax = 127.0 if mode == 'int8' else 448.0
+        scale = w.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / qmax
+        if mode == 'int8':
+            q = torch.round(w / scale).clamp(-127, 127).to(torch.int8)
+        else:
+            q = (w / scale).to(torch.float8_e4m3fn)
+        self.in_features, self.out_features, self.mode = linear.in_features, linear.out_features, mode
+        self.register_buffer('weight_q', q)
+        self.register_buffer('scale', scale.to(linear.weight.dtype))
+        self.bias = linear.bias
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, mode={self.mode}"
+
+    @property
+    def weight(self):
+        return self.weight_q.to(self.scale.dtype) * self.scale
+
+    def forward(self, x):
+        w = self.weight_q.to(x.device).to(x.dtype) * self.scale.to(x.device, x.dtype)
+        bias = None if self.bias is None else self.bias.to(x.device, x.dtype)
+        return torch.nn.functional.linear(x, w, bias)
+
+def quantize_linears(module, mode, min_weights=QUANT_MIN_WEIGHTS):
+    # Заменяет крупные nn.Linear на QuantLinear на месте; возвращает (слоёв, байт было, байт стало)
+    if mode == 'fp8' and not hasattr(torch, 'float8_e4m3fn'):
+        raise RuntimeError("fp8 weights need torch with float8_e4m3fn")
+    count, before, after = 0, 0, 0
+    for name, child in list(module.named_children()):
+        if isinstance(child, torch.nn.Linear) and child.weight.numel() >= min_weights:
+            q = QuantLinear(child, mode)
+            setattr(module, name, q)
+            count += 1
+            before += child.weight.numel() * child.weight.element_size()
+            after += q.weight_q.numel() * q.weight_q.element_size() + q.scale.numel() * q.scale.element_size()
+        elif not isinstance(child, QuantLinear):
+            c, b, a = quantize_linears(child, mode, min_weights)
+            count, before, after = count + c, before + b, after + a
+    return count, before, after
+
+def quantize_dit(pipe, mode, device):
+    dit = pipe.denoising_model()
+    t0 = time.time()
+    count, before, after = quantize_linears(dit, mode)
+    # квантованные веса малы и всегда живут на устройстве, в бюджет выгрузки они не входят
+    for m in dit.modules():
+        if isinstance(m, QuantLinear):
+            m.to(device)
+    print(f"[Quant] DiT {mode}: {count} Linear layers | {before / 2**30:.2f} GB -> {after / 2**30:.2f} GB ({time.time() - t0:.1f} s)")
+    VRAM_INFO.update(dit_weights=mode, quant_bytes=after)
+
+def plan_buffer_bytes(plan, batch=1):
+    # LQ в bf16 и выход модели (bf16 + float-копия в tensor2video) для самого длинного вызова пайплайна по плану
+    spans = plan_spans(plan)
+    F = plan['F'] if len(spans) == 1 else max(len(chunk_indices(s, e, True)) for s, e in spans)
+    px = plan['tW'] * plan['tH'] * 3
+    return batch * (px * F * 2 + px * max(1, F - 4) * (2 + 4))
 
-def init_pipeline():
-    print(torch.cuda.current_device(), torch.cuda.get_device_name(torch.cuda.current_device()))
+def dit_param_budget(total_params, free_bytes, fixed_bytes, reserve_bytes, headroom_bytes, bytes_per_param=2):
+    # None — DiT целиком на устройстве; иначе сколько параметров туда помещается
+    n = max(0, int((free_bytes - fixed_bytes - reserve_bytes - headroom_bytes) // bytes_per_param))
+    return None if n >= total_params else n
+
+def resolve_dit_budget(pipe, dit_params, device, plans=()):
+    mode = DIT_PERSISTENT.strip().lower()
+    if mode in ('', 'all', 'none'):
+        return None
+    if mode != 'auto':
+        n = int(float(mode))
+        return None if n >= dit_params else n
+    if not str(device).startswith('cuda'):
+        return None
+    free, _ = torch.cuda.mem_get_info(torch.device(device))
+    fixed = sum(p.numel() * p.element_size() for p in pipe.vae.parameters())
+    reserve = max((plan_buffer_bytes(p, BATCH) for p in plans), default=BUFFER_BYTES)
+    known = ' (from launcher plans)' if not plans and BUFFER_BYTES else '' if plans else ' (inputs unknown)'
+    print(f"[VRAM] free {free / 2**30:.1f} GB | VAE {fixed / 2**30:.1f} GB | LQ+output buffers {reserve / 2**30:.1f} GB"
+          f"{known} | headroom {DIT_HEADROOM_GB:.1f} GB")
+    return dit_param_budget(dit_params, free, fixed, reserve, DIT_HEADROOM_GB * 2**30)
+
+def init_pipeline(device='cuda', plans=(), weights=DIT_WEIGHTS):
+    if STUB_PIPELINE:
+        print(f"[Pipeline] stub on {device}")
+        return StubPipeline()
+    # модельный стек импортируется только здесь: режимы --plan и заглушка работают без него
+    from diffsynth import ModelManager, FlashVSRFullPipeline
+    from utils.utils import Causal_LQ4x_Proj
+
+    if str(device).startswith('cuda'):
+        print(torch.cuda.current_device(), torch.cuda.get_device_name(torch.cuda.current_device()))
     mm = ModelManager(torch_dtype=torch.bfloat16, device="cpu")
     mm.load_models([
         "./FlashVSR-v1.1/diffusion_pytorch_model_streaming_dmd.safetensors",
         "./FlashVSR-v1.1/Wan2.1_VAE.pth",
     ])
-    pipe = FlashVSRFullPipeline.from_model_manager(mm, device="cuda")
-    pipe.denoising_model().LQ_proj_in = Causal_LQ4x_Proj(in_dim=3, out_dim=1536, layer_num=1).to("cuda", dtype=torch.bfloat16)
+    pipe = FlashVSRFullPipeline.from_model_manager(mm, device=device)
+    pipe.denoising_model().LQ_proj_in = Causal_LQ4x_Proj(in_dim=3, out_dim=1536, layer_num=1).to(device, dtype=torch.bfloat16)
     LQ_proj_in_path = "./FlashVSR-v1.1/LQ_proj_in.ckpt"
     if os.path.exists(LQ_proj_in_path):
         pipe.denoising_model().LQ_proj_in.load_state_dict(torch.load(LQ_proj_in_path, map_location="cpu"), strict=True)
 
-    pipe.denoising_model().LQ_proj_in.to('cuda')
+    pipe.denoising_model().LQ_proj_in.to(device)
     pipe.vae.model.encoder = None
     pipe.vae.model.conv1 = None
-    pipe.to('cuda'); pipe.enable_vram_management(num_persistent_param_in_dit=None)
+    if weights != 'bf16':
+        quantize_dit(pipe, weights, device)
+    dit_params = sum(p.numel() for p in pipe.denoising_model().parameters())
+    budget = resolve_dit_budget(pipe, dit_params, device, plans)
+    if budget is None:
+        pipe.to(device)
+    else:
+        # DiT целиком на устройство не переносим: постоянную часть туда переложит enable_vram_management
+        pipe.vae.to(device)
+    pipe.enable_vram_management(num_persistent_param_in_dit=budget)
     pipe.init_cross_kv(); pipe.load_models_to_device(["dit","vae"])
+
+    persistent = dit_params if budget is None else budget
+    VRAM_INFO.update(dit_params=dit_params, dit_persistent=persistent, mode=DIT_PERSISTENT)
+    print(f"[VRAM] DiT {dit_params / 1e9:.2f}B params | on device {persistent / 1e9:.2f}B ({100 * persistent / dit_params:.0f}%)"
+          f" | offloaded {(dit_params - persistent) * 2 / 2**30:.1f} GB")
     return pipe
 
+MODE_FLAGS = ("--plan", "--worker", "--bench", "--tune", "--check-quant")
+
 def parse_cli_inputs(default_inputs):
     args = sys.argv[1:]
     if not args:
@@ -230,9 +984,43 @@ def parse_cli_inputs(default_inputs):
                 "Usage:\n"
                 "  python infer_flashvsr_v1.1_full_modified.py [--video1.mp4 --video2.mp4 ...]\n"
                 "Пример: python infer_flashvsr_v1.1_full_modified.py --example1000.mp4 --example1001.mp4\n"
-                "Можно также указывать полный путь или относительный путь без префикса '--'."
+                "Можно также указывать полный путь или относительный путь без префикса '--'.\n"
+                "Переменные окружения:\n"
+                "  FLASHVSR_CHUNK_FRAMES=N       обрабатывать длинные клипы чанками по N кадров с возобновлением после сбоя\n"
+                "  FLASHVSR_CROP_BARS=1          обрезать чёрные полосы до апскейла и дорисовать их на выходе\n"
+                "  FLASHVSR_DEDUP=T              пропускать через модель только уникальные кадры (порог разницы T, 0 — точные повторы)\n"
+                "  FLASHVSR_SCENE_CUT=T          резать вход по склейкам сцен (порог 0..1) на независимые сегменты\n"
+                "  FLASHVSR_KEEP_ALL_FRAMES=1    не отбрасывать хвост: добивать до 8n+1 и обрезать выход\n"
+                "  FLASHVSR_FRAME_SOURCE=ffmpeg  масштабировать кадры прямо в пайпе декодера ffmpeg\n"
+                "  FLASHVSR_FRAME_SOURCE=yuv     читать yuv420p, конверсия в RGB и ресайз на устройстве\n"
+                "  FLASHVSR_FRAME_STORE=DIR      держать декодированные кадры в memmap-файле в DIR, а не в RAM\n"
+                "  FLASHVSR_KEEP_FRAME_STORE=1   не удалять файл хранилища после сохранения выхода\n"
+                "  --plan                        только посчитать планы и вывести их строками @@PLAN {json}\n"
+                "  --worker                      режим воркера launch_flashvsr.py: задания JSON-строками со stdin\n"
+                "  FLASHVSR_DEVICE=cuda:1|cpu    устройство процесса\n"
+                "  FLASHVSR_STUB_PIPELINE=1      заглушка вместо модели (проверка без GPU и весов)\n"
+                "  FLASHVSR_SCHEDULE=shape|sjf|deadline|list  порядок входов (группы одной формы, короткие первыми, по срокам)\n"
+                "  FLASHVSR_DEADLINES=file.json  сроки для deadline: {вход: ISO-время или unix time}\n"
+                "  FLASHVSR_BATCH=N              упаковывать до N клипов одной формы в один вызов пайплайна\n"
+                "  --bench                       замерить пропускную способность (по одному и пачками) и записать калибровку\n"
+                "  FLASHVSR_SPARSE_RATIO=R       sparse_ratio вместо значения из таблицы (по умолчанию 2.0)\n"
+                "  FLASHVSR_LOCAL_RANGE=N        local_range вместо значения из таблицы (по умолчанию 9)\n"
+                "  FLASHVSR_PREVIEW=mid|T|T1-T2  сначала быстрое превью одного блока (середина, с T секунды или окно)\n"
+                "  FLASHVSR_PREVIEW_CONTINUE=1   после превью обработать входы целиком тем же пайплайном\n"
+                "  FLASHVSR_DIT_PERSISTENT=all|auto|N  сколько параметров DiT держать на устройстве (остальное выгружать на CPU)\n"
+                "  FLASHVSR_DIT_WEIGHTS=bf16|int8|fp8  хранить веса Linear-слоёв DiT в int8/fp8 с масштабом на канал\n"
+                "  --check-quant clip.mp4        сверить квантованный DiT с bf16 на CPU (слой и короткий клип)\n"
+                "  --tune                        подобрать sparse_ratio/local_range на калибровочных клипах по корзинам разрешения\n"
+                "  --check-yuv                   проверить точность YUV->RGB против эталона на CPU\n"
+                "  --check-chunks                сверить число выходных кадров по чанкам и сценам с клипом целиком"
             )
             sys.exit(0)
+        if raw in MODE_FLAGS:
+            continue
+        if raw == "--check-yuv":
+            sys.exit(0 if check_yuv_conversion('cuda' if torch.cuda.is_available() else 'cpu') else 1)
+        if raw == "--check-chunks":
+            sys.exit(0 if check_chunk_frames() else 1)
 
         entry = raw
         if entry.startswith("--"):
@@ -254,6 +1042,494 @@ def parse_cli_inputs(default_inputs):
     print("[CLI] Используем входные файлы:", parsed)
     return parsed
 
+def flush_device_cache(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.empty_cache(); torch.cuda.ipc_collect()
+
+def plan_shape(plan, F=None):
+    # Форма вызова пайплайна: клипы одной формы переиспользуют блоки аллокатора; F округляется до корзины FRAME_BUCKET.
+    # Без F — форма первого вызова по плану: у чанкованного клипа это первый чанк, а не клип целиком
+    if F is None:
+        spans = plan_spans(plan)
+        F = plan['F'] if len(spans) == 1 else len(chunk_indices(*spans[0], keep_all=True))
+    return plan['tW'], plan['tH'], (F + FRAME_BUCKET - 1) // FRAME_BUCKET
+
+class ShapeCacheFlusher:
+    # Сбрасывает кэш устройства только при смене формы, а не перед каждым клипом
+    def __init__(self, device):
+        self.device, self.shape = device, None
+
+    def __call__(self, plan, F=None):
+        shape = plan_shape(plan, F)
+        if shape != self.shape:
+            if self.shape is not None:
+                print(f"[Schedule] shape {self.shape} -> {shape}: flushing device cache")
+            flush_device_cache(self.device)
+            self.shape = shape
+
+def load_deadlines(path):
+    if not path:
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        raw = json.load(f)
+    out = {}
+    for k, v in raw.items():
+        if isinstance(v, (int, float)):
+            out[k] = float(v)
+        else:
+            from datetime import datetime
+            out[k] = datetime.fromisoformat(str(v)).timestamp()
+    return out
+
+def plan_first_input(inputs, scale=4):
+    # План первого входа, который планируется без ошибки: {вход: план или None для упавших до него}
+    planned = {}
+    for p in inputs:
+        name = os.path.basename(p.rstrip('/'))
+        if name.startswith('.'):
+            continue
+        try:
+            planned[p] = plan_input(p, scale=scale, prepass=False)
+            break
+        except Exception as e:
+            print(f"[Error] {name}: {e}")
+            planned[p] = None
+    return planned
+
+def schedule_inputs(inputs, scale=4, policy='shape', planned=None):
+    # Планы всех входов считаются заранее (уже готовые берутся из planned); порядок задаёт policy (см. FLASHVSR_SCHEDULE)
+    jobs, planned = [], planned or {}
+    for order, p in enumerate(inputs):
+        name = os.path.basename(p.rstrip('/'))
+        if name.startswith('.'):
+            continue
+        plan = planned.get(p)
+        if p in planned and plan is None:
+            continue
+        try:
+            if plan is None:
+                plan = plan_input(p, scale=scale)
+            elif 'cuts' not in plan:
+                plan_scene_cuts(plan)  # план превью: полного прохода по клипу ещё не было
+        except Exception as e:
+            print(f"[Error] {name}: {e}")
+            continue
+        jobs.append({'input': p, 'plan': plan, 'order': order, 'shape': plan_shape(plan), 'cost': plan_cost(plan)})
+    if policy == 'list':
+        return jobs
+
+    deadlines = load_deadlines(DEADLINES) if policy == 'deadline' else {}
+    for j in jobs:
+        j['deadline'] = deadlines.get(j['input'], deadlines.get(j['plan']['name'], float('inf')))
+
+    groups = {}
+    for j in jobs:
+        groups.setdefault(j['shape'], []).append(j)
+    groups = list(groups.values())  # порядок первого появления формы
+    if policy == 'sjf':
+        for g in groups:
+            g.sort(key=lambda j: j['cost'])
+        groups.sort(key=lambda g: sum(j['cost'] for j in g))
+    elif policy == 'deadline':
+        for g in groups:
+            g.sort(key=lambda j: (j['deadline'], j['cost']))
+        groups.sort(key=lambda g: g[0]['deadline'])
+
+    ordered = [j for g in groups for j in g]
+    print(f"[Schedule] policy={policy}: {len(ordered)} input(s) in {len(groups)} shape group(s)")
+    for j in ordered:
+        tW, tH, fb = j['shape']
+        dl = j.get('deadline', float('inf'))
+        dl_str = time.strftime('%Y-%m-%d %H:%M', time.localtime(dl)) if dl != float('inf') else '-'
+        print(f"[Schedule]   {j['plan']['name']}: {tW}x{tH} F={j['plan']['F']} | {j['cost']:.1f} MP-frames | deadline {dl_str}")
+    return ordered
+
+def plan_cost(plan):
+    # Оценка стоимости клипа: выходные мегапиксель-кадры, которые пройдут через пайплайн
+    return plan['tW'] * plan['tH'] * plan['F'] / 1e6
+
+def output_path(result_root, name, seed=0):
+    return os.path.join(result_root, f"FlashVSR_v1.1_Full_{name.split('.')[0]}_seed{seed}.mp4")
+
+def process_input(pipe, p, result_root, seed=0, scale=4, sparse_ratio=None, local_range=None, dtype=torch.bfloat16, device='cuda', plan=None, flush=None):
+    name = os.path.basename(p.rstrip('/'))
+    if name.startswith('.'):
+        return None
+    out_path = output_path(result_root, name, seed)
+    if plan is None:
+        plan = plan_input(p, scale=scale)
+
+    flush = flush or ShapeCacheFlusher(device)
+    attach_frame_store(plan)
+    saved = False
+    try:
+        if len(plan_spans(plan)) > 1:
+            run_chunked(pipe, plan, out_path, seed=seed, sparse_ratio=sparse_ratio, local_range=local_range, dtype=dtype, device=device, flush=flush)
+        else:
+            idx, expand = schedule_frames(plan, 0, plan['total'])
+            report_dedup(plan)
+            flush(plan, len(idx))
+            LQ = build_lq_tensor(plan, idx, dtype=dtype, device=device)
+            video = run_pipeline(pipe, LQ, len(idx), plan['tH'], plan['tW'], seed=seed, sparse_ratio=sparse_ratio, local_range=local_range)
+            video = pad_bars(expand_frames(tensor2video(video), expand), plan)
+            save_video(video, out_path, fps=plan['fps'], quality=6)
+        saved = True
+    finally:
+        release_frame_store(plan, delete=saved)
+    return out_path
+
+_batch_unsupported = set()  # id(pipe), для которых батч уже не сработал
+
+def run_pipeline_batch(pipe, LQ, F, th, tw, seed=0, sparse_ratio=None, local_range=None):
+    # LQ: B C F H W -> список из B выходов C T H W. Если пайплайн не умеет батч (ошибка или
+    # неожиданная форма выхода), запоминаем это и дальше гоняем клипы по одному
+    B = LQ.shape[0]
+    if B > 1 and id(pipe) not in _batch_unsupported:
+        try:
+            out = run_pipeline(pipe, LQ, F, th, tw, seed=seed, sparse_ratio=sparse_ratio, local_range=local_range)
+            if out.dim() == 5 and out.shape[0] == B:
+                return list(out)
+            raise ValueError(f"unexpected output shape {tuple(out.shape)}")
+        except Exception as e:
+            print(f"[Batch] pipeline does not support B={B} ({type(e).__name__}: {e}); running clips one by one")
+            _batch_unsupported.add(id(pipe))
+    return [run_pipeline(pipe, LQ[b:b+1], F, th, tw, seed=seed, sparse_ratio=sparse_ratio, local_range=local_range) for b in range(B)]
+
+def run_batch(pipe, batch, result_root, seed=0, sparse_ratio=None, local_range=None, dtype=torch.bfloat16, device='cuda', **kwargs):
+    # batch: клипы с одинаковыми (F, tH, tW) и уже посчитанным расписанием кадров
+    plan0, F = batch[0]['plan'], len(batch[0]['idx'])
+    print(f"[Batch] {len(batch)} clip(s) {plan0['tW']}x{plan0['tH']} F={F}: {', '.join(b['plan']['name'] for b in batch)}")
+    LQ = torch.cat([build_lq_tensor(b['plan'], b['idx'], dtype=dtype, device=device) for b in batch], 0)
+    videos = run_pipeline_batch(pipe, LQ, F, plan0['tH'], plan0['tW'], seed=seed, sparse_ratio=sparse_ratio, local_range=local_range)
+    del LQ
+    for b, video in zip(batch, videos):
+        frames = pad_bars(expand_frames(tensor2video(video), b['expand']), b['plan'])
+        save_video(frames, output_path(result_root, b['plan']['name'], seed), fps=b['plan']['fps'], quality=6)
+        release_frame_store(b['plan'])
+
+def report_run(device, plans, t0):
+    # Цена выбранного бюджета DiT: скорость и пик памяти на каждый вызов
+    dt = time.time() - t0
+    line = f"[Run] {', '.join(p['name'] for p in plans)}: {dt:.1f} s | {sum(plan_cost(p) for p in plans) / max(dt, 1e-9):.2f} MP-frames/s"
+    if str(device).startswith('cuda'):
+        line += f" | peak VRAM {torch.cuda.max_memory_allocated() / 2**30:.1f} GB"
+        torch.cuda.reset_peak_memory_stats()
+    if VRAM_INFO:
+        line += f" | DiT on device {100 * VRAM_INFO['dit_persistent'] / VRAM_INFO['dit_params']:.0f}%"
+    print(line)
+
+def run_jobs(pipe, jobs, result_root, batch=1, **kwargs):
+    # Последовательные клипы одинаковой формы копятся в пачку до batch штук; чанкованные идут по одному
+    device = kwargs.get('device', 'cuda')
+    flush = ShapeCacheFlusher(device)
+    pending = []
+
+    def drain():
+        if not pending:
+            return
+        flush(pending[0]['plan'], len(pending[0]['idx']))
+        t0 = time.time()
+        try:
+            run_batch(pipe, pending, result_root, **kwargs)
+            report_run(device, [b['plan'] for b in pending], t0)
+        except Exception as e:
+            print(f"[Error] {', '.join(b['plan']['name'] for b in pending)}: {e}")
+            flush_device_cache(device)
+            flush.shape = None
+            for b in pending:
+                release_frame_store(b['plan'], delete=False)
+        pending.clear()
+
+    for job in jobs:
+        plan = job['plan']
+        if batch > 1 and len(plan_spans(plan)) == 1:
+            try:
+                idx, expand = schedule_frames(attach_frame_store(plan), 0, plan['total'])
+                report_dedup(plan)
+            except Exception as e:
+                print(f"[Error] {plan['name']}: {e}")
+                release_frame_store(plan, delete=False)
+                continue
+            key = (len(idx), plan['tH'], plan['tW'])
+            if pending and pending[0]['key'] != key:
+                drain()
+            pending.append({'plan': plan, 'idx': idx, 'expand': expand, 'key': key})
+            if len(pending) >= batch:
+                drain()
+            continue
+
+        drain()
+        t0 = time.time()
+        try:
+            process_input(pipe, job['input'], result_root, plan=plan, flush=flush, **kwargs)
+            report_run(device, [plan], t0)
+        except Exception as e:
+            print(f"[Error] {plan['name']}: {e}")
+            flush_device_cache(device)
+            flush.shape = None
+    drain()
+
+def preview_window(plan, spec=PREVIEW, frames=PREVIEW_FRAMES):
+    # [start, stop) исходных кадров длиной 8k-3: с 4 кадрами добивки это ровно один блок 8k+1
+    total, fps = plan['n_read'], plan.get('fps') or 30
+    if '-' in spec:
+        a, b = (float(x) for x in spec.split('-', 1))
+        start, n = int(a * fps), int((b - a) * fps)
+    elif spec in ('1', 'mid'):
+        start, n = None, frames
+    else:
+        start, n = int(float(spec) * fps), frames
+    n = min(chunk_len_8n3(n), total)
+    if start is None:
+        start = (total - n) // 2
+    start = max(0, min(start, total - n))
+    return start, start + n
+
+def preview_plan(plan, max_long):
+    # Тот же клип с пониженным капом выхода: пересчитывается только геометрия
+    if not max_long:
+        return plan
+    w0, h0 = plan['w0'], plan['h0']
+    if plan.get('bars'):
+        b = plan['bars']
+        w0, h0 = w0 - b['l'] - b['r'], h0 - b['t'] - b['b']
+    sW, sH, tW, tH, scale_eff = compute_scaled_and_target_dims(w0, h0, scale=plan['scale_eff'], max_w=max_long, max_h=max_long, multiple=128)
+    pplan = dict(plan, sW=sW, sH=sH, tW=tW, tH=tH, scale_eff=scale_eff)
+    if plan.get('bars'):
+        pplan['frame_dims'] = compute_scaled_and_target_dims(
+            plan['w0'], plan['h0'], scale=plan['frame_dims'][4], max_w=max_long, max_h=max_long, multiple=128)
+    return pplan
+
+def run_preview(pipe, plan, result_root, seed=0, sparse_ratio=None, local_range=None, dtype=torch.bfloat16, device='cuda', flush=None, **kwargs):
+    t0 = time.time()
+    start, stop = preview_window(plan)
+    pplan = preview_plan(plan, PREVIEW_MAX_LONG)
+    idx = chunk_indices(start, stop, keep_all=True)
+    if flush:
+        flush(pplan, len(idx))
+    LQ = build_lq_tensor(pplan, idx, dtype=dtype, device=device)
+    video = run_pipeline(pipe, LQ, len(idx), pplan['tH'], pplan['tW'], seed=seed, sparse_ratio=sparse_ratio, local_range=local_range)
+    del LQ
+    frames = pad_bars(tensor2video(video)[:stop - start], pplan)
+    out_path = output_path(os.path.join(result_root, "preview"), plan['name'], seed)
+    save_video(frames, out_path, fps=plan['fps'], quality=6)
+    print(f"[{plan['name']}] Preview: frames {start}..{stop - 1} at {pplan['tW']}x{pplan['tH']} -> {out_path} ({time.time() - t0:.1f} s)")
+    return out_path
+
+def run_previews(pipe, jobs, result_root, **kwargs):
+    # Сначала превью всех входов, чтобы посмотреть результат до многоминутной полной обработки
+    device = kwargs.get('device', 'cuda')
+    flush = ShapeCacheFlusher(device)
+    for job in jobs:
+        try:
+            run_preview(pipe, job['plan'], result_root, flush=flush, **kwargs)
+        except Exception as e:
+            print(f"[Error] {job['plan']['name']} preview: {e}")
+            flush_device_cache(device)
+            flush.shape = None
+
+def sync_device(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+
+def update_variant_file(path, entry):
+    # JSON вида {вариант: запись}: чужие варианты сохраняются, файл подменяется атомарно
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data[VARIANT] = entry
+    tmp = path + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+def record_throughput(entry, path=THROUGHPUT_FILE):
+    # Калибровка: последние замеры по вариантам, на неё опирается прогноз в analyze_videos.py
+    update_variant_file(path, entry)
+
+def run_benchmark(pipe, jobs, batch=1, seed=0, sparse_ratio=None, local_range=None, dtype=torch.bfloat16, device='cuda'):
+    # Для каждой группы клипов одной формы: по одному против пачками по batch; итог — MP-кадров/с
+    groups = {}
+    for job in jobs:
+        plan = job['plan']
+        groups.setdefault((plan['F'], plan['tH'], plan['tW']), []).append(plan)
+
+    samples = []
+    for (F, th, tw), plans in groups.items():
+        flush_device_cache(device)
+        if str(device).startswith('cuda'):
+            torch.cuda.reset_peak_memory_stats()
+        LQs = [build_lq_tensor(p, p['idx'], dtype=dtype, device=device) for p in plans]
+        mpf = tw * th * F * len(plans) / 1e6
+        run_pipeline(pipe, LQs[0], F, th, tw, seed=seed, sparse_ratio=sparse_ratio, local_range=local_range)   # прогрев
+        sync_device(device)
+
+        t0 = time.time()
+        for LQ in LQs:
+            run_pipeline(pipe, LQ, F, th, tw, seed=seed, sparse_ratio=sparse_ratio, local_range=local_range)
+        sync_device(device)
+        t_single = time.time() - t0
+        sample = {'tW': tw, 'tH': th, 'F': F, 'clips': len(plans), 'mp_frames': round(mpf, 3),
+                  'single_mpf_per_s': round(mpf / t_single, 4)}
+
+        if batch > 1 and len(plans) > 1:
+            t0 = time.time()
+            for s in range(0, len(LQs), batch):
+                run_pipeline_batch(pipe, torch.cat(LQs[s:s + batch], 0), F, th, tw, seed=seed, sparse_ratio=sparse_ratio, local_range=local_range)
+            sync_device(device)
+            t_batch = time.time() - t0
+            sample['batch'] = batch
+            sample['batch_mpf_per_s'] = round(mpf / t_batch, 4)
+            sample['batched'] = id(pipe) not in _batch_unsupported
+        if str(device).startswith('cuda'):
+            sample['peak_vram_gb'] = round(torch.cuda.max_memory_allocated() / 2**30, 2)
+
+        line = f"[Bench] {tw}x{th} F={F} x{len(plans)}: one by one {sample['single_mpf_per_s']:.2f} MP-frames/s"
+        if 'batch_mpf_per_s' in sample:
+            line += (f" | batch={batch}{'' if sample['batched'] else ' (fallback)'} {sample['batch_mpf_per_s']:.2f} MP-frames/s "
+                     f"(x{sample['batch_mpf_per_s'] / sample['single_mpf_per_s']:.2f})")
+        print(line)
+        samples.append(sample)
+        del LQs
+
+    if samples:
+        total_mpf = sum(s['mp_frames'] for s in samples)
+        total_t = sum(s['mp_frames'] / s['single_mpf_per_s'] for s in samples)
+        device_name = torch.cuda.get_device_name(torch.cuda.current_device()) if str(device).startswith('cuda') else 'cpu'
+        record_throughput({'mpf_per_s': round(total_mpf / total_t, 4), 'device': device_name,
+                           'measured': time.strftime('%Y-%m-%dT%H:%M:%S'), 'samples': samples, 'vram': dict(VRAM_INFO)})
+        print(f"[Bench] {VARIANT}: {total_mpf / total_t:.2f} MP-frames/s -> {THROUGHPUT_FILE}")
+
+def tune_thumb(video, long_side=256):
+    # Выход C T H W в [-1, 1] -> уменьшенные кадры T C h w на CPU для дешёвого сравнения
+    v = video.float().permute(1, 0, 2, 3)
+    k = max(1, max(v.shape[-2:]) // long_side)
+    return torch.nn.functional.avg_pool2d(v, k).cpu() if k > 1 else v.cpu()
+
+def tune_psnr(a, b):
+    mse = torch.mean((a - b) ** 2).item()
+    return 99.0 if mse <= 1e-10 else min(99.0, float(10 * np.log10(4.0 / mse)))  # размах [-1, 1] -> peak^2 = 4
+
+def run_tuning(pipe, jobs, seed=0, dtype=torch.bfloat16, device='cuda'):
+    # По первому калибровочному клипу на корзину разрешения: TUNE_FRAMES кадров из середины,
+    # сетка sparse_ratio x local_range. Стабильность — PSNR уменьшенного выхода против базового
+    # (2.0, local_range по умолчанию); в таблицу идёт самый быстрый вариант не ниже TUNE_MIN_PSNR
+    calib = {}
+    for job in jobs:
+        plan = job['plan']
+        calib.setdefault(resolution_bucket(plan['tW'], plan['tH']), plan)
+
+    table = dict(load_tuning())
+    for bucket, plan in calib.items():
+        flush_device_cache(device)
+        n = largest_8n1_leq(min(len(plan['idx']), max(9, TUNE_FRAMES)))
+        start = (len(plan['idx']) - n) // 2
+        th, tw = plan['tH'], plan['tW']
+        LQ = build_lq_tensor(plan, plan['idx'][start:start + n], dtype=dtype, device=device)
+        print(f"[Tune] {bucket}: {plan['name']} {tw}x{th} F={n}")
+        run_pipeline(pipe, LQ, n, th, tw, seed=seed, sparse_ratio=DEFAULT_SPARSE_RATIO, local_range=DEFAULT_LOCAL_RANGE)  # прогрев
+
+        base, base_t, rows = None, None, []
+        for sr, lr in [(DEFAULT_SPARSE_RATIO, DEFAULT_LOCAL_RANGE)] + [g for g in TUNE_GRID if g != (DEFAULT_SPARSE_RATIO, DEFAULT_LOCAL_RANGE)]:
+            sync_device(device)
+            t0 = time.time()
+            out = run_pipeline(pipe, LQ, n, th, tw, seed=seed, sparse_ratio=sr, local_range=lr)
+            sync_device(device)
+            dt = time.time() - t0
+            thumb = tune_thumb(out)
+            del out
+            if base is None:
+                base, base_t = thumb, dt
+            row = {'sparse_ratio': sr, 'local_range': lr, 'seconds': round(dt, 4),
+                   'speedup': round(base_t / dt, 4), 'psnr': round(tune_psnr(thumb, base), 2)}
+            rows.append(row)
+            print(f"[Tune]   sparse_ratio={sr} local_range={lr}: {dt:.2f} s (x{row['speedup']:.2f}) | PSNR vs base {row['psnr']:.2f} dB")
+        del LQ, base
+
+        ok = [r for r in rows if r['psnr'] >= TUNE_MIN_PSNR]
+        best = min(ok, key=lambda r: r['seconds'])
+        table[bucket] = {'sparse_ratio': best['sparse_ratio'], 'local_range': best['local_range'],
+                         'speedup': best['speedup'], 'psnr': best['psnr'], 'calibration': plan['name'],
+                         'tW': tw, 'tH': th, 'F': n, 'measured': time.strftime('%Y-%m-%dT%H:%M:%S'), 'candidates': rows}
+        print(f"[Tune] {bucket}: -> sparse_ratio={best['sparse_ratio']} local_range={best['local_range']} "
+              f"(x{best['speedup']:.2f}, {best['psnr']:.2f} dB)")
+
+    update_variant_file(TUNING_FILE, table)
+    _tuning_cache.pop(TUNING_FILE, None)
+    print(f"[Tune] {VARIANT}: {len(calib)} bucket(s) -> {TUNING_FILE}")
+
+def check_quant_parity(inputs, mode, frames=9, seed=0):
+    # Паритет квантования на CPU: сначала случайный слой, затем клип (первый вход, 9 кадров с начала)
+    # через один и тот же пайплайн в bf16, после чего его DiT квантуется на месте и прогон повторяется
+    torch.manual_seed(seed)
+    lin = torch.nn.Linear(1536, 1536).to(torch.bfloat16)
+    x = torch.randn(64, 1536, dtype=torch.bfloat16)
+    ref, got = lin(x).float(), QuantLinear(lin, mode)(x).float()
+    layer_err = ((got - ref).norm() / ref.norm()).item()
+    layer_ok = layer_err <= (0.02 if mode == 'int8' else 0.05)
+    print(f"[Quant] {mode} Linear 1536x1536: relative error {layer_err:.4f} -> {'OK' if layer_ok else 'FAIL'}")
+    if STUB_PIPELINE or not inputs:
+        return layer_ok
+
+    plan = plan_input(inputs[0], scale=4)
+    n = largest_8n1_leq(min(len(plan['idx']), max(9, frames)))
+    th, tw = plan['tH'], plan['tW']
+    pipe = init_pipeline('cpu', weights='bf16')
+    LQ = build_lq_tensor(plan, plan['idx'][:n], dtype=torch.bfloat16, device='cpu')
+    t0 = time.time()
+    base = tune_thumb(run_pipeline(pipe, LQ, n, th, tw, seed=seed))
+    t_base = time.time() - t0
+    quantize_dit(pipe, mode, 'cpu')
+    t0 = time.time()
+    got = tune_thumb(run_pipeline(pipe, LQ, n, th, tw, seed=seed))
+    t_q = time.time() - t0
+    psnr = tune_psnr(got, base)
+    ok = psnr >= QUANT_MIN_PSNR
+    print(f"[Quant] {plan['name']} {tw}x{th} F={n} on cpu: bf16 {t_base:.1f} s | {mode} {t_q:.1f} s | "
+          f"PSNR vs bf16 {psnr:.2f} dB -> {'OK' if ok else 'FAIL'}")
+    return layer_ok and ok
+
+PLAN_LOCAL_KEYS = ('store', 'thumbs', 'ffmpeg_reader')  # кэши и ресурсы процесса, в JSON плана не попадают
+
+def plan_to_json(plan):
+    # План целиком (геометрия, полосы, склейки, индексы кадров): воркер берёт его как есть и не повторяет проходы
+    keep = {k: v for k, v in plan.items() if k not in PLAN_LOCAL_KEYS}
+    return json.loads(json.dumps(keep, default=lambda o: o.tolist()))
+
+def print_plans(inputs, scale=4):
+    for p in inputs:
+        res = {'input': p}
+        try:
+            plan = plan_input(p, scale=scale)
+            res.update({k: plan[k] for k in ('name', 'total', 'n_out', 'F', 'tW', 'tH')}, ok=True, cost=plan_cost(plan),
+                       buffer_bytes=plan_buffer_bytes(plan, BATCH), plan=plan_to_json(plan))
+        except Exception as e:
+            res.update(ok=False, error=f"{type(e).__name__}: {e}")
+        print("@@PLAN " + json.dumps(res, ensure_ascii=False), flush=True)
+
+def worker_loop(pipe, result_root, **kwargs):
+    # Протокол launch_flashvsr.py: задание — JSON-строка {"input": ..., "plan": {...}} на stdin,
+    # итог — строка "@@RESULT {json}" на stdout; остальной вывод идёт в общий лог.
+    # План из --plan берётся как есть; без него (ручной запуск) считается заново
+    flush = ShapeCacheFlusher(kwargs.get('device', 'cuda'))
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        job = json.loads(line)
+        res, t0 = {'input': job['input']}, time.time()
+        try:
+            plan = job.get('plan') or plan_input(job['input'], scale=kwargs.get('scale', 4))
+            res.update(ok=True, out=process_input(pipe, job['input'], result_root, plan=plan, flush=flush, **kwargs))
+        except Exception as e:
+            res.update(ok=False, error=f"{type(e).__name__}: {e}")
+            flush_device_cache(kwargs.get('device', 'cuda'))
+            flush.shape = None
+        res['seconds'] = round(time.time() - t0, 3)
+        print("@@RESULT " + json.dumps(res, ensure_ascii=False), flush=True)
+
 def main():
     RESULT_ROOT = "./results"
     os.makedirs(RESULT_ROOT, exist_ok=True)
@@ -265,33 +1541,49 @@ def main():
         # "./inputs/example3.mp4",
     ]
     inputs = parse_cli_inputs(default_inputs)
-    seed, scale, dtype, device = 0, 4, torch.bfloat16, 'cuda'
-    sparse_ratio = 2.0      # Recommended: 1.5 or 2.0. 1.5 → faster; 2.0 → more stable.
-    pipe = init_pipeline()
-
-    for p in inputs:
-        torch.cuda.empty_cache(); torch.cuda.ipc_collect()
-        name = os.path.basename(p.rstrip('/'))
-        if name.startswith('.'):
-            continue
-        try:
-            LQ, th, tw, F, fps = prepare_input_tensor(p, scale=scale, dtype=dtype, device=device)
-        except Exception as e:
-            print(f"[Error] {name}: {e}")
-            continue
+    seed, scale, dtype, device = 0, 4, torch.bfloat16, DEVICE
+    # Recommended: 1.5 or 2.0. 1.5 → faster; 2.0 → more stable. None — из таблицы --tune для разрешения
+    sparse_ratio = float(SPARSE_RATIO) if SPARSE_RATIO else None
+    local_range = int(LOCAL_RANGE) if LOCAL_RANGE else None
+    if "--plan" in sys.argv[1:]:
+        print_plans(inputs, scale=scale)
+        return
+    if "--check-quant" in sys.argv[1:]:
+        sys.exit(0 if check_quant_parity(inputs, DIT_WEIGHTS if DIT_WEIGHTS != 'bf16' else 'int8') else 1)
+    run_kwargs = dict(seed=seed, scale=scale, sparse_ratio=sparse_ratio, local_range=local_range, dtype=dtype, device=device)
+    if "--worker" in sys.argv[1:]:
+        worker_loop(init_pipeline(device), RESULT_ROOT, **run_kwargs)
+        return
+    # планы считаются до загрузки модели: по ним резервируются буферы при FLASHVSR_DIT_PERSISTENT=auto
+    modes = {"--bench", "--tune"} & set(sys.argv[1:])
+    policy = 'shape' if modes else SCHEDULE
+    # превью первого входа — сразу после его плана и загрузки модели, остальные входы планируются потом;
+    # для полной обработки с бюджетом auto нужны буферы всех входов, там планы считаются заранее
+    early = bool(PREVIEW) and not modes and not (PREVIEW_CONTINUE and DIT_PERSISTENT.strip().lower() == 'auto')
+    previewed = []
+    if early:
+        planned = plan_first_input(inputs, scale=scale)
+        previewed = [p for p in planned.values() if p is not None]
+        pipe = init_pipeline(device, plans=previewed)
+        run_previews(pipe, [{'plan': p} for p in previewed], RESULT_ROOT, **run_kwargs)
+        jobs = schedule_inputs(inputs, scale=scale, policy=policy, planned=planned)
+    else:
+        jobs = schedule_inputs(inputs, scale=scale, policy=policy)
+        pipe = init_pipeline(device, plans=[j['plan'] for j in jobs])
+    if "--bench" in sys.argv[1:]:
+        run_benchmark(pipe, jobs, batch=max(2, BATCH), seed=seed, sparse_ratio=sparse_ratio, local_range=local_range, dtype=dtype, device=device)
+        return
+    if "--tune" in sys.argv[1:]:
+        run_tuning(pipe, jobs, seed=seed, dtype=dtype, device=device)
+        return
 
-        video = pipe(
-            prompt="", negative_prompt="", cfg_scale=1.0, num_inference_steps=1, seed=seed, 
-            tiled=False,# Disable tiling: faster inference but higher VRAM usage. 
-                        # Set to True for lower memory consumption at the cost of speed.
-            LQ_video=LQ, num_frames=F, height=th, width=tw, is_full_block=False, if_buffer=True,
-            topk_ratio=sparse_ratio*768*1280/(th*tw), 
-            kv_ratio=3.0,
-            local_range=9, # Recommended: 9 or 11. local_range=9 → sharper details; 11 → more stable results.
-            color_fix = True,
-        )
-        video = tensor2video(video)
-        save_video(video, os.path.join(RESULT_ROOT, f"FlashVSR_v1.1_Full_{name.split('.')[0]}_seed{seed}.mp4"), fps=fps, quality=6)
+    if PREVIEW:
+        run_previews(pipe, [j for j in jobs if all(j['plan'] is not p for p in previewed)], RESULT_ROOT, **run_kwargs)
+        if not PREVIEW_CONTINUE:
+            print("Done.")
+            return
+        flush_device_cache(device)
+    run_jobs(pipe, jobs, RESULT_ROOT, batch=BATCH, **run_kwargs)
     print("Done.")
 
 if __name__ == "__main__":
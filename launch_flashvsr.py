@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Запуск FlashVSR на нескольких устройствах: по процессу-воркеру на каждое устройство
+Входы раздаются динамически, самые дорогие (по выходным мегапиксель-кадрам из плана) — первыми
+"""
+
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+ENTRY = os.environ.get(
+    "FLASHVSR_ENTRY",
+    str(Path(__file__).parent / "infer_flashvsr_v1.1_full_modified.py"),
+)
+# Сколько раз перезапускать упавший воркер и повторять задание, на котором он упал
+MAX_RESTARTS = int(os.environ.get("FLASHVSR_MAX_RESTARTS", "1"))
+RESULT_ROOT = Path("./results")
+
+
+def detect_devices():
+    """
+    Определяет список устройств: FLASHVSR_DEVICES="cuda:0,cuda:1,cpu" или все видимые GPU
+
+    Returns:
+        Список строк устройств
+    """
+    configured = os.environ.get("FLASHVSR_DEVICES", "").strip()
+    if configured:
+        return [d.strip() for d in configured.split(',') if d.strip()]
+    try:
+        import torch
+        count = torch.cuda.device_count()
+    except Exception:
+        count = 0
+    return [f"cuda:{i}" for i in range(count)] or ["cpu"]
+
+
+def worker_env(device, buffer_bytes=0):
+    """
+    Окружение воркера: каждый видит ровно одну карту как cuda, либо не видит ни одной
+
+    Args:
+        device: Строка устройства (cuda:N или cpu)
+        buffer_bytes: Буферы LQ+выхода крупнейшего входа (для FLASHVSR_DIT_PERSISTENT=auto); 0 — не задавать
+
+    Returns:
+        Словарь переменных окружения
+    """
+    env = dict(os.environ)
+    env["PYTHONUNBUFFERED"] = "1"
+    if device.startswith("cuda"):
+        env["CUDA_VISIBLE_DEVICES"] = device.split(":", 1)[1] if ":" in device else "0"
+        env["FLASHVSR_DEVICE"] = "cuda"
+    else:
+        env["CUDA_VISIBLE_DEVICES"] = ""
+        env["FLASHVSR_DEVICE"] = "cpu"
+    if buffer_bytes:
+        env["FLASHVSR_BUFFER_BYTES"] = str(buffer_bytes)
+    return env
+
+
+def plan_jobs(inputs):
+    """
+    Считает планы всех входов одним процессом без модели (режим --plan)
+
+    Args:
+        inputs: Список путей ко входам
+
+    Returns:
+        Кортеж (jobs, failed): задания с оценкой стоимости и полным планом, который воркер возьмёт как есть,
+        и входы, для которых план не построился
+    """
+    cmd = [sys.executable, ENTRY, "--plan"] + list(inputs)
+    env = worker_env("cpu")
+    result = subprocess.run(cmd, capture_output=True, text=True, env=env)
+    jobs, failed = [], []
+    for line in result.stdout.splitlines():
+        if not line.startswith("@@PLAN "):
+            continue
+        plan = json.loads(line[len("@@PLAN "):])
+        if plan.get("ok"):
+            jobs.append({"input": plan["input"], "cost": plan["cost"], "plan": plan.get("plan"),
+                         "buffer_bytes": plan.get("buffer_bytes", 0), "attempts": 0})
+        else:
+            failed.append({"input": plan["input"], "ok": False, "error": plan.get("error"), "device": None})
+    if result.returncode != 0 and not jobs and not failed:
+        raise RuntimeError(f"Планирование завершилось с ошибкой:\n{result.stderr[-2000:]}")
+    return jobs, failed
+
+
+class Worker:
+    """Процесс-воркер на одном устройстве и поток, читающий его вывод в общую очередь событий"""
+
+    def __init__(self, tag, device, events, buffer_bytes=0):
+        self.tag = tag
+        self.device = device
+        self.events = events
+        self.buffer_bytes = buffer_bytes
+        self.job = None
+        self.restarts = 0
+        self.start()
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, ENTRY, "--worker"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, bufsize=1, env=worker_env(self.device, self.buffer_bytes),
+        )
+        threading.Thread(target=self._read, args=(self.proc,), daemon=True).start()
+
+    def _read(self, proc):
+        for line in proc.stdout:
+            self.events.put((self, proc, line.rstrip("\n")))
+        proc.wait()
+        self.events.put((self, proc, None))
+
+    def send(self, job):
+        """
+        Передаёт задание воркеру
+
+        Returns:
+            False, если процесс уже не читает stdin (умер); задание тогда не считается попыткой
+        """
+        try:
+            msg = {"input": job["input"], "plan": job["plan"]} if job.get("plan") else {"input": job["input"]}
+            self.proc.stdin.write(json.dumps(msg, ensure_ascii=False) + "\n")
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError):
+            return False
+        self.job = job
+        job["attempts"] += 1
+        return True
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except Exception:
+            pass
+
+
+def run(inputs, devices, log_path, on_send=None):
+    """
+    Раздаёт задания воркерам и собирает результаты
+
+    Args:
+        inputs: Список входов
+        devices: Список устройств
+        log_path: Путь к общему логу
+        on_send: Необязательный вызов on_send(worker, job) перед передачей задания (для самопроверки)
+
+    Returns:
+        Список результатов по входам
+    """
+    jobs, results = plan_jobs(inputs)
+    # LPT: дорогие клипы первыми, чтобы хвост из одного длинного клипа не держал всю партию
+    jobs.sort(key=lambda j: j["cost"], reverse=True)
+    total = len(jobs) + len(results)
+    print(f"Заданий: {len(jobs)} | суммарно {sum(j['cost'] for j in jobs):.1f} MP-кадров | устройства: {', '.join(devices)}")
+
+    # любой вход может достаться любому воркеру: резерв под буферы — по самому крупному
+    buffer_bytes = max((j["buffer_bytes"] for j in jobs), default=0)
+    events = queue.Queue()
+    with open(log_path, "a", encoding="utf-8") as log:
+        workers = [Worker(f"{i}:{d}", d, events, buffer_bytes) for i, d in enumerate(devices[:len(jobs)])]
+        idle = list(workers)
+
+        def dispatch():
+            while idle and jobs:
+                w = idle.pop(0)
+                job = jobs.pop(0)
+                if on_send:
+                    on_send(w, job)
+                if not w.send(job):
+                    # воркер умер, пока простаивал: задание обратно в очередь, сам воркер
+                    # перезапустится или выбудет по событию смерти процесса
+                    print(f"[{w.tag}] воркер не принимает задания, {job['input']} вернётся в очередь")
+                    jobs.insert(0, job)
+                    continue
+                print(f"[{w.tag}] -> {job['input']} ({job['cost']:.1f} MP-кадров)")
+            if not jobs and not any(x.job for x in workers):
+                # всё выполнено: простаивающие воркеры завершаются по EOF на stdin. Раньше закрывать
+                # нельзя — задание упавшего воркера может вернуться в очередь
+                while idle:
+                    idle.pop().close()
+
+        dispatch()
+        alive = len(workers)
+        while alive:
+            w, proc, line = events.get()
+            if proc is not w.proc:
+                continue  # хвост вывода уже перезапущенного процесса
+
+            if line is None:
+                # Процесс воркера умер: задание повторяем, воркер перезапускаем в пределах лимита
+                job, w.job = w.job, None
+                if job is not None:
+                    if job["attempts"] <= MAX_RESTARTS:
+                        print(f"[{w.tag}] воркер упал на {job['input']}, задание вернётся в очередь")
+                        jobs.insert(0, job)
+                    else:
+                        results.append({"input": job["input"], "ok": False, "device": w.device,
+                                        "error": f"worker exited with code {proc.returncode}"})
+                if w.restarts < MAX_RESTARTS and jobs:
+                    w.restarts += 1
+                    w.start()
+                    idle.append(w)
+                else:
+                    alive -= 1
+                    if w in idle:
+                        idle.remove(w)
+                dispatch()
+                continue
+
+            log.write(f"[{w.tag}] {line}\n")
+            if not line.startswith("@@RESULT "):
+                continue
+            res = json.loads(line[len("@@RESULT "):])
+            res["device"] = w.device
+            results.append(res)
+            w.job = None
+            status = "OK" if res.get("ok") else f"ОШИБКА: {res.get('error')}"
+            print(f"[{w.tag}] [{len(results)}/{total}] {res['input']}: {status} ({res.get('seconds', 0):.1f} с)")
+            idle.append(w)
+            dispatch()
+
+    # все воркеры исчерпали перезапуски, а задания остались
+    for job in jobs:
+        results.append({"input": job["input"], "ok": False, "device": None, "error": "no workers left"})
+    return results
+
+
+def self_test(clips=4, frames=9):
+    """
+    Самопроверка раздачи на заглушке модели: два cpu-воркера, один умирает до передачи задания
+    (запись в stdin падает с BrokenPipeError), другой убивается во время задания.
+    Все входы должны завершиться успешно и дать выходные файлы
+
+    Args:
+        clips: Сколько тестовых клипов сгенерировать
+        frames: Кадров в клипе
+
+    Returns:
+        True, если проверка прошла
+    """
+    global MAX_RESTARTS
+    MAX_RESTARTS = max(1, MAX_RESTARTS)
+    os.environ["FLASHVSR_STUB_PIPELINE"] = "1"
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            inputs = []
+            for i in range(clips):
+                path = f"selftest_{i}.mp4"
+                subprocess.run(
+                    ['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', f"testsrc=size={96 + 32 * i}x64:rate=25",
+                     '-frames:v', str(frames), '-pix_fmt', 'yuv420p', path],
+                    check=True,
+                )
+                inputs.append(path)
+
+            sends = []
+
+            def sabotage(worker, job):
+                sends.append(job["input"])
+                if len(sends) == 1:
+                    worker.proc.kill()
+                    worker.proc.wait()
+                    print(f"[Self-test] {worker.tag}: процесс убит до передачи {job['input']}")
+                elif len(sends) == 3:
+                    threading.Timer(0.5, worker.proc.kill).start()
+                    print(f"[Self-test] {worker.tag}: процесс будет убит во время {job['input']}")
+
+            RESULT_ROOT.mkdir(parents=True, exist_ok=True)
+            results = run(inputs, ["cpu", "cpu"], RESULT_ROOT / "launch_selftest.log", on_send=sabotage)
+            outputs = list((RESULT_ROOT).glob("*.mp4"))
+        finally:
+            os.chdir(cwd)
+
+    ok = (sorted(r["input"] for r in results) == sorted(inputs)
+          and all(r.get("ok") for r in results) and len(outputs) == len(inputs))
+    print(f"[Self-test] результатов {len(results)}/{len(inputs)}, успешных {sum(1 for r in results if r.get('ok'))}, "
+          f"выходов {len(outputs)} -> {'OK' if ok else 'FAIL'}")
+    return ok
+
+
+def main():
+    """Основная функция скрипта"""
+    if "--self-test" in sys.argv[1:]:
+        sys.exit(0 if self_test() else 1)
+    inputs = [a[2:] if a.startswith("--") else a for a in sys.argv[1:]]
+    if not inputs or inputs[0] in ("h", "help", "-h"):
+        print(
+            "Usage:\n"
+            "  FLASHVSR_DEVICES=cuda:0,cuda:1,cpu python launch_flashvsr.py video1.mp4 video2.mp4 ...\n"
+            "Переменные окружения:\n"
+            "  FLASHVSR_DEVICES       список устройств (по умолчанию все видимые GPU, иначе cpu)\n"
+            "  FLASHVSR_ENTRY         скрипт воркера (по умолчанию infer_flashvsr_v1.1_full_modified.py)\n"
+            "  FLASHVSR_MAX_RESTARTS  сколько раз перезапускать упавший воркер (по умолчанию 1)\n"
+            "  --self-test            проверить раздачу на заглушке модели с убитыми воркерами\n"
+            "Остальные FLASHVSR_* передаются воркерам как есть."
+        )
+        sys.exit(0)
+
+    devices = detect_devices()
+    RESULT_ROOT.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+    log_path = RESULT_ROOT / f"launch_{stamp}.log"
+
+    t0 = time.time()
+    results = run(inputs, devices, log_path)
+    elapsed = time.time() - t0
+
+    summary_path = RESULT_ROOT / f"launch_{stamp}.json"
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump({"devices": devices, "seconds": round(elapsed, 3), "results": results}, f, ensure_ascii=False, indent=1)
+
+    ok = sum(1 for r in results if r.get("ok"))
+    print("=" * 70)
+    print(f"Успешно: {ok}/{len(results)} | время: {elapsed:.1f} с")
+    for r in results:
+        if not r.get("ok"):
+            print(f"   - {r['input']}: {r.get('error')}")
+    print(f"Лог: {log_path}")
+    print(f"Итоги: {summary_path}")
+    print("=" * 70)
+    sys.exit(0 if ok == len(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
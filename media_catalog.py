@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Локальный каталог видео в SQLite: результаты ffprobe по ключу (путь, размер, mtime)
+При повторном сканировании опрашиваются только новые и изменённые файлы,
+запросы по папкам (все res720, суммарная длительность) идут из индекса
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+from mp4_header import probe_fast
+from probe_videos import probe_files
+
+
+CATALOG_PATH = os.environ.get(
+    "MEDIA_CATALOG",
+    str(Path(__file__).parent / "media_catalog.sqlite"),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path      TEXT PRIMARY KEY,
+    folder    TEXT NOT NULL,
+    name      TEXT NOT NULL,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    ok        INTEGER NOT NULL,
+    codec     TEXT,
+    width     INTEGER,
+    height    INTEGER,
+    fps       REAL,
+    nb_frames INTEGER,
+    duration  REAL,
+    bitrate   INTEGER,
+    profile   TEXT,
+    level     TEXT,
+    pix_fmt   TEXT,
+    probe     TEXT,
+    scanned   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_folder ON files(folder);
+"""
+
+
+def open_catalog(path=CATALOG_PATH):
+    """
+    Открывает (и при необходимости создаёт) каталог
+
+    Args:
+        path: Путь к файлу SQLite
+
+    Returns:
+        Соединение sqlite3
+    """
+    conn = sqlite3.connect(str(path))
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def scan_folder(conn, folder, pattern='*.mp4', fast=False):
+    """
+    Инкрементально сканирует папку: ffprobe только для новых и изменённых файлов,
+    записи исчезнувших файлов удаляются
+
+    Args:
+        conn: Соединение каталога
+        folder: Путь к папке
+        pattern: Маска файлов
+        fast: Достаточно длительности и геометрии: MP4/MOV читаются из заголовка без ffprobe.
+            Такие записи без полной сводки при обычном сканировании дочитываются ffprobe
+
+    Returns:
+        Словарь {'total', 'probed', 'removed'}
+    """
+    folder = Path(folder).resolve()
+    on_disk = {}
+    for file in folder.glob(pattern):
+        if file.is_file():
+            st = file.stat()
+            on_disk[str(file)] = (file, st.st_size, st.st_mtime_ns)
+
+    known = {
+        row['path']: (row['size'], row['mtime_ns'], bool(row['full']))
+        for row in conn.execute(
+            "SELECT path, size, mtime_ns, probe IS NOT NULL OR ok = 0 AS full FROM files WHERE folder = ?",
+            (str(folder),),
+        )
+    }
+    changed = [
+        file for key, (file, size, mtime) in on_disk.items()
+        if key not in known or known[key][:2] != (size, mtime) or not (fast or known[key][2])
+    ]
+    removed = [key for key in known if key not in on_disk]
+
+    now = time.time()
+    rows = []
+    for file, info in (probe_fast(changed) if fast else probe_files(changed)).items():
+        _, size, mtime = on_disk[str(file)]
+        info = info or {}
+        rows.append((
+            str(file), str(folder), file.name, size, mtime, int(bool(info.get('codec'))),
+            info.get('codec'), info.get('width'), info.get('height'), info.get('fps'),
+            info.get('nb_frames'), info.get('duration'),
+            int(info['bitrate']) if info.get('bitrate') else None,
+            info.get('profile'), info.get('level'), info.get('pix_fmt'),
+            json.dumps(info, ensure_ascii=False) if 'streams' in info else None, now,
+        ))
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.executemany("DELETE FROM files WHERE path = ?", [(key,) for key in removed])
+
+    return {'total': len(on_disk), 'probed': len(changed), 'removed': len(removed)}
+
+
+def cached_probe(conn, paths):
+    """
+    Сводки probe_videos для файлов из каталога (папки должны быть просканированы)
+
+    Args:
+        conn: Соединение каталога
+        paths: Пути к файлам
+
+    Returns:
+        Словарь {путь: сводка или None}
+    """
+    result = {}
+    for path in paths:
+        row = conn.execute("SELECT probe FROM files WHERE path = ?", (str(Path(path).resolve()),)).fetchone()
+        result[path] = json.loads(row['probe']) if row and row['probe'] else None
+    return result
+
+
+def probe_folder(folder, paths, pattern='*.mp4', conn=None):
+    """
+    Сканирует папку и отдаёт сводки для её файлов: замена probe_files для скриптов
+
+    Args:
+        folder: Папка с файлами
+        paths: Файлы этой папки, для которых нужны сводки
+        pattern: Маска файлов папки
+        conn: Открытый каталог (по умолчанию открывается CATALOG_PATH)
+
+    Returns:
+        Словарь {путь: сводка или None}
+    """
+    own = conn is None
+    conn = conn or open_catalog()
+    try:
+        stats = scan_folder(conn, folder, pattern)
+        if stats['probed'] or stats['removed']:
+            print(f"Каталог: {folder}: новых/изменённых {stats['probed']}, удалённых {stats['removed']} из {stats['total']}")
+        return cached_probe(conn, paths)
+    finally:
+        if own:
+            conn.close()
+
+
+def find_files(conn, folder=None, name_like=None):
+    """
+    Файлы из индекса по папке и/или подстроке имени (например 'res720', с учётом регистра)
+
+    Args:
+        conn: Соединение каталога
+        folder: Папка или None — все папки
+        name_like: Подстрока имени или None
+
+    Returns:
+        Список Path, отсортированный по пути
+    """
+    sql, args = "SELECT path FROM files WHERE 1 = 1", []
+    if folder is not None:
+        sql += " AND folder = ?"
+        args.append(str(Path(folder).resolve()))
+    if name_like:
+        sql += " AND name GLOB ?"
+        args.append(f"*{name_like}*")
+    return [Path(row['path']) for row in conn.execute(sql + " ORDER BY path", args)]
+
+
+def folder_files(conn, folder):
+    """
+    Параметры файлов папки из индекса
+
+    Args:
+        conn: Соединение каталога
+        folder: Папка
+
+    Returns:
+        Список словарей: path, ok, width, height, fps, nb_frames, duration
+    """
+    return [dict(row) for row in conn.execute(
+        "SELECT path, ok, width, height, fps, nb_frames, duration FROM files WHERE folder = ? ORDER BY path",
+        (str(Path(folder).resolve()),),
+    )]
+
+
+def folder_totals(conn, folder=None):
+    """
+    Количество, длительность и размер по папкам из индекса
+
+    Args:
+        conn: Соединение каталога
+        folder: Одна папка или None — все
+
+    Returns:
+        Список словарей: folder, count, total_duration, total_size, files_with_duration, files_without_duration
+    """
+    sql = """
+        SELECT folder, COUNT(*) AS count, COALESCE(SUM(duration), 0.0) AS total_duration,
+               SUM(size) AS total_size, COUNT(duration) AS files_with_duration,
+               COUNT(*) - COUNT(duration) AS files_without_duration
+        FROM files
+    """
+    args = []
+    if folder is not None:
+        sql += " WHERE folder = ?"
+        args.append(str(Path(folder).resolve()))
+    return [dict(row) for row in conn.execute(sql + " GROUP BY folder ORDER BY folder", args)]
+
+
+def main():
+    """Сканирование и запросы из командной строки"""
+    args = sys.argv[1:]
+    if not args or args[0] not in ('scan', 'find', 'totals'):
+        print(
+            "Usage:\n"
+            "  python media_catalog.py scan DIR [DIR ...]   инкрементально обновить каталог\n"
+            "  python media_catalog.py find res720 [DIR]    файлы с подстрокой в имени\n"
+            "  python media_catalog.py totals [DIR]         длительность и размер по папкам\n"
+            f"Каталог: {CATALOG_PATH} (переменная MEDIA_CATALOG)"
+        )
+        sys.exit(0)
+
+    conn = open_catalog()
+    if args[0] == 'scan':
+        for folder in args[1:]:
+            stats = scan_folder(conn, folder)
+            print(f"{folder}: файлов {stats['total']}, опрошено {stats['probed']}, удалено {stats['removed']}")
+    elif args[0] == 'find':
+        for path in find_files(conn, args[2] if len(args) > 2 else None, args[1] if len(args) > 1 else None):
+            print(path)
+    else:
+        for row in folder_totals(conn, args[1] if len(args) > 1 else None):
+            print(f"{row['folder']}: {row['count']} файлов | {row['total_duration']:.2f} с | {row['total_size']} байт")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Быстрое чтение длительности и геометрии MP4/MOV без подпроцесса
+Разбирает боксы moov/mvhd, trak/tkhd, mdhd, stsd, stsz и stts; для других контейнеров,
+фрагментированных и нестандартных файлов — ffprobe через probe_videos
+"""
+
+import struct
+import sys
+import time
+from pathlib import Path
+
+from probe_videos import probe_files
+
+
+MP4_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.3gp')
+CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts'}
+# fourcc записи stsd -> codec_name ffprobe
+FOURCC_CODECS = {
+    b'avc1': 'h264', b'avc3': 'h264', b'hvc1': 'hevc', b'hev1': 'hevc',
+    b'av01': 'av1', b'vp09': 'vp9', b'vp08': 'vp8', b'mp4v': 'mpeg4',
+    b'mjpa': 'mjpeg', b'jpeg': 'mjpeg', b'apch': 'prores', b'apcn': 'prores',
+    b'apcs': 'prores', b'apco': 'prores', b'ap4h': 'prores',
+}
+
+
+def iter_boxes(data, start=0, end=None):
+    """
+    Перебирает боксы в буфере
+
+    Args:
+        data: bytes с боксами
+        start: Смещение начала
+        end: Смещение конца (по умолчанию конец буфера)
+
+    Returns:
+        Генератор (тип, начало содержимого, конец бокса)
+    """
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield kind, pos + header, pos + size
+        pos += size
+
+
+def read_moov(f):
+    """Находит moov среди боксов верхнего уровня (в начале или в конце файла) и читает его целиком"""
+    f.seek(0, 2)
+    file_size = f.tell()
+    pos, moof = 0, False
+    moov = None
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        head = f.read(16)
+        if len(head) < 8:
+            break
+        size, kind = struct.unpack_from('>I4s', head)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', head, 8)[0]
+            header = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header:
+            break
+        if kind == b'moov':
+            f.seek(pos + header)
+            moov = f.read(size - header)
+        elif kind == b'moof':
+            moof = True
+        pos += size
+    return moov, moof, file_size
+
+
+def parse_track(data, start, end):
+    """Поля одной дорожки trak: handler, размеры, timescale, stsd, stsz, stts"""
+    track = {}
+
+    def walk(s, e):
+        for kind, body, box_end in iter_boxes(data, s, e):
+            if kind in CONTAINERS:
+                walk(body, box_end)
+            elif kind == b'tkhd':
+                off = body + (4 + 32 + 52 if data[body] == 1 else 4 + 20 + 52)
+                w, h = struct.unpack_from('>II', data, off)
+                track['tkhd_size'] = (w >> 16, h >> 16)
+            elif kind == b'hdlr':
+                # в MOV есть второй hdlr (minf, тип данных) — тип дорожки даёт первый, из mdia
+                track.setdefault('handler', data[body + 8:body + 12])
+            elif kind == b'mdhd':
+                if data[body] == 1:
+                    track['timescale'], track['duration'] = struct.unpack_from('>IQ', data, body + 20)
+                else:
+                    track['timescale'], track['duration'] = struct.unpack_from('>II', data, body + 12)
+            elif kind == b'stsd':
+                entry = body + 8
+                track['fourcc'] = data[entry + 4:entry + 8]
+                if entry + 36 <= box_end:
+                    track['stsd_size'] = struct.unpack_from('>HH', data, entry + 32)
+            elif kind == b'stsz':
+                track['samples'] = struct.unpack_from('>I', data, body + 8)[0]
+            elif kind == b'stts':
+                count = struct.unpack_from('>I', data, body + 4)[0]
+                track['stts'] = [struct.unpack_from('>II', data, body + 8 + 8 * i) for i in range(count)]
+
+    walk(start, end)
+    return track
+
+
+def read_mp4_header(path):
+    """
+    Читает длительность, размеры, число кадров и FPS видео из заголовка MP4/MOV
+
+    Args:
+        path: Путь к файлу
+
+    Returns:
+        Словарь в формате сводки probe_videos (codec, width, height, fps, nb_frames, duration, size)
+        или None, если файл не удаётся разобрать надёжно
+    """
+    try:
+        with open(path, 'rb') as f:
+            moov, moof, size = read_moov(f)
+    except OSError:
+        return None
+    if moov is None or moof:
+        return None  # фрагментированные файлы и файлы без moov — через ffprobe
+
+    try:
+        movie_duration, tracks = None, []
+        for kind, body, box_end in iter_boxes(moov):
+            if kind == b'mvhd':
+                if moov[body] == 1:
+                    timescale, duration = struct.unpack_from('>IQ', moov, body + 20)
+                else:
+                    timescale, duration = struct.unpack_from('>II', moov, body + 12)
+                movie_duration = duration / timescale if timescale else None
+            elif kind == b'trak':
+                tracks.append(parse_track(moov, body, box_end))
+            elif kind == b'mvex':
+                return None
+    except (struct.error, IndexError):
+        return None
+
+    video = next((t for t in tracks if t.get('handler') == b'vide'), None)
+    if not video or not movie_duration or not video.get('stts') or not video.get('timescale'):
+        return None
+
+    # FPS как r_frame_rate у ffprobe для CFR: timescale / самый частый шаг stts
+    _, delta = max(video['stts'], key=lambda entry: entry[0])
+    width, height = video.get('stsd_size') or video.get('tkhd_size') or (None, None)
+    return {
+        'codec': FOURCC_CODECS.get(video.get('fourcc'), (video.get('fourcc') or b'').decode('latin-1') or None),
+        'width': width,
+        'height': height,
+        'fps': video['timescale'] / delta if delta else None,
+        'nb_frames': video.get('samples') or sum(count for count, _ in video['stts']),
+        'duration': movie_duration,
+        'size': size,
+        'source': 'mp4',
+    }
+
+
+def probe_fast(paths, jobs=None):
+    """
+    Сводки для файлов: MP4/MOV из заголовка, остальное и неразобранное — через ffprobe
+
+    Args:
+        paths: Пути к файлам
+        jobs: Размер пула ffprobe (по умолчанию как в probe_videos)
+
+    Returns:
+        Словарь {путь: сводка или None}
+    """
+    result, rest = {}, []
+    for path in paths:
+        info = read_mp4_header(path) if str(path).lower().endswith(MP4_EXTENSIONS) else None
+        if info is None:
+            rest.append(path)
+        result[path] = info
+    if rest:
+        result.update(probe_files(rest) if jobs is None else probe_files(rest, jobs))
+    return result
+
+
+def cross_check(paths, duration_tol=0.05, fps_tol=1e-3):
+    """
+    Сверяет разбор заголовков с ffprobe
+
+    Args:
+        paths: Пути к MP4/MOV файлам
+        duration_tol: Допуск по длительности, секунд
+        fps_tol: Относительный допуск по FPS
+
+    Returns:
+        Список расхождений (пустой — всё совпало)
+    """
+    t0 = time.time()
+    fast = {path: read_mp4_header(path) for path in paths}
+    t_fast = time.time() - t0
+    t0 = time.time()
+    ref = probe_files(paths)
+    t_ref = time.time() - t0
+
+    problems, fallback = [], 0
+    for path in paths:
+        got, want = fast[path], ref[path]
+        if want is None:
+            continue
+        if got is None:
+            fallback += 1  # фрагментированный или нестандартный файл: probe_fast отдаст его ffprobe
+            continue
+        for key in ('codec', 'width', 'height', 'nb_frames'):
+            if want.get(key) is not None and got[key] != want[key]:
+                problems.append(f"{path}: {key} {got[key]} != ffprobe {want[key]}")
+        if want.get('duration') is not None and abs(got['duration'] - want['duration']) > duration_tol:
+            problems.append(f"{path}: duration {got['duration']:.3f} != ffprobe {want['duration']:.3f}")
+        if want.get('fps') and abs(got['fps'] - want['fps']) > fps_tol * want['fps']:
+            problems.append(f"{path}: fps {got['fps']:.4f} != ffprobe {want['fps']:.4f}")
+
+    print(
+        f"Файлов: {len(paths)} | заголовки: {t_fast:.3f} с | ffprobe: {t_ref:.3f} с | "
+        f"через ffprobe: {fallback} | расхождений: {len(problems)}"
+    )
+    return problems
+
+
+def main():
+    """Сверка с ffprobe: python mp4_header.py upload/ [файл.mp4 ...]"""
+    paths = []
+    for arg in sys.argv[1:] or ['upload']:
+        p = Path(arg)
+        paths += sorted(f for f in p.iterdir() if f.suffix.lower() in MP4_EXTENSIONS) if p.is_dir() else [p]
+    problems = cross_check(paths)
+    for line in problems:
+        print(f"   - {line}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
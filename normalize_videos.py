@@ -5,11 +5,24 @@
 """
 
 import os
+import shutil
 import subprocess
 import sys
-import json
 from pathlib import Path
 
+from media_catalog import probe_folder
+from probe_videos import probe_file
+from rewrite_journal import Journal
+from transcode_pool import run_pool, stderr_tail
+
+
+# Длинные файлы (дольше двух сегментов) режутся по ключевым кадрам на сегменты этой длины,
+# сегменты кодируются параллельно и склеиваются без перекодирования; 0 — выключено
+SEGMENT_SECONDS = float(os.environ.get("NORMALIZE_SEGMENT_SECONDS", "0"))
+
+# Журнал перезаписи в каждой обрабатываемой папке (удаляется после полного прохода)
+JOURNAL_NAME = '.normalize_journal'
+
 
 def check_ffmpeg():
     """Проверяет наличие ffmpeg в системе"""
@@ -32,93 +45,104 @@ def get_reference_params(reference_file):
     Returns:
         Словарь с параметрами эталона
     """
-    try:
-        cmd = [
-            'ffprobe',
-            '-v', 'quiet',
-            '-print_format', 'json',
-            '-show_streams',
-            '-show_format',
-            str(reference_file)
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-        
-        # Находим видео поток
-        video_stream = None
-        for stream in data.get('streams', []):
-            if stream.get('codec_type') == 'video':
-                video_stream = stream
-                break
-        
-        if not video_stream:
-            return None
-        
-        params = {
-            'codec': video_stream.get('codec_name', 'h264'),
-            'profile': video_stream.get('profile', ''),
-            'level': video_stream.get('level', ''),
-            'pix_fmt': video_stream.get('pix_fmt', 'yuv420p'),
-            'bitrate': video_stream.get('bit_rate', ''),
-            'encoder': video_stream.get('tags', {}).get('encoder', ''),
-        }
-        
-        return params
-    except Exception as e:
-        print(f"Ошибка при чтении эталонного файла: {e}")
+    probe = probe_file(reference_file)
+    if not probe or not probe['codec']:
+        print(f"Ошибка при чтении эталонного файла: {reference_file}")
         return None
+    
+    video_stream = next(s for s in probe['streams'] if s.get('codec_type') == 'video')
+    params = {
+        'codec': video_stream.get('codec_name', 'h264'),
+        'profile': video_stream.get('profile', ''),
+        'level': video_stream.get('level', ''),
+        'pix_fmt': video_stream.get('pix_fmt', 'yuv420p'),
+        'bitrate': video_stream.get('bit_rate', ''),
+        'encoder': probe['encoder'],
+    }
+    
+    return params
 
 
-def get_video_params(video_file):
+def get_video_params(video_file, probe=None):
     """
     Получает разрешение и FPS из видео файла
     
     Args:
         video_file: Путь к видео файлу
+        probe: Готовая сводка probe_videos, если файл уже опрошен
     
     Returns:
         Словарь с width, height, fps или None
     """
-    try:
-        cmd = [
-            'ffprobe',
-            '-v', 'quiet',
-            '-print_format', 'json',
-            '-show_streams',
-            '-select_streams', 'v:0',
-            str(video_file)
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-        
-        if not data.get('streams'):
-            return None
-        
-        stream = data['streams'][0]
-        
-        # Получаем FPS
-        fps_str = stream.get('r_frame_rate', '30/1')
-        if '/' in fps_str:
-            num, den = map(int, fps_str.split('/'))
-            fps = num / den if den > 0 else 30.0
-        else:
-            fps = float(fps_str) if fps_str else 30.0
-        
-        params = {
-            'width': stream.get('width'),
-            'height': stream.get('height'),
-            'fps': fps
-        }
-        
-        return params
-    except Exception as e:
-        print(f"  Ошибка при чтении параметров: {e}")
+    if probe is None:
+        probe = probe_file(video_file)
+    if not probe or not probe['codec']:
+        print(f"  Ошибка при чтении параметров: {video_file}")
         return None
+    
+    params = {
+        'width': probe['width'],
+        'height': probe['height'],
+        'fps': probe['fps'] or 30.0
+    }
+    
+    return params
+
+
+def normalization_action(probe, reference_params):
+    """
+    Решает, нужно ли перекодировать файл
+    
+    Args:
+        probe: Сводка probe_videos файла
+        reference_params: Параметры эталона
+    
+    Returns:
+        'skip' — видео уже соответствует эталону и в файле нет других потоков,
+        'remux' — видео соответствует, но есть лишние потоки (аудио, данные, субтитры):
+        достаточно перепаковать видеопоток без перекодирования,
+        'encode' — кодек, профиль, уровень или пиксельный формат отличаются
+    """
+    stream_matches = (
+        probe.get('codec') == reference_params.get('codec')
+        and probe.get('profile') == reference_params.get('profile')
+        and str(probe.get('level')) == str(reference_params.get('level'))
+        and probe.get('pix_fmt') == reference_params.get('pix_fmt')
+    )
+    if not stream_matches:
+        return 'encode'
+    # Нормализованный файл содержит только видеопоток (-map 0:v:0, -an)
+    if len(probe.get('streams', [])) > 1:
+        return 'remux'
+    return 'skip'
+
+
+def remux_command(input_file, output_file, threads=None):
+    """
+    Собирает команду ffmpeg, оставляющую только видеопоток без перекодирования
+    
+    Args:
+        input_file: Путь к исходному файлу
+        output_file: Путь к выходному файлу
+        threads: Не используется (копирование потока), для единообразия с normalize_command
+    
+    Returns:
+        Список аргументов ffmpeg
+    """
+    return [
+        'ffmpeg',
+        '-i', str(input_file),
+        '-map', '0:v:0',  # Только видео поток
+        '-c:v', 'copy',  # Без перекодирования
+        '-an',  # Без аудио (как в эталоне)
+        '-y',  # Перезаписывать если существует
+        str(output_file)
+    ]
 
 
-def normalize_video(input_file, output_file, reference_params, width, height, fps):
+def normalize_command(input_file, output_file, reference_params, width, height, fps, threads=None):
     """
-    Нормализует видео файл под параметры эталона
+    Собирает команду ffmpeg для нормализации видео под параметры эталона
     
     Args:
         input_file: Путь к исходному файлу
@@ -127,10 +151,11 @@ def normalize_video(input_file, output_file, reference_params, width, height, fp
         width: Ширина (сохраняется)
         height: Высота (сохраняется)
         fps: FPS (сохраняется)
-    """
-    if not reference_params:
-        return False
+        threads: Потоки ffmpeg или None — на усмотрение ffmpeg
     
+    Returns:
+        Список аргументов ffmpeg
+    """
     # Преобразуем профиль для ffmpeg
     profile = reference_params.get('profile', 'high444')
     # "High 4:4:4 Predictive" -> "high444"
@@ -164,11 +189,15 @@ def normalize_video(input_file, output_file, reference_params, width, height, fp
         '-i', str(input_file),
         '-map', '0:v:0',  # Только видео поток
         '-c:v', 'libx264',  # Кодек H.264
+    ]
+    if threads:
+        cmd.extend(['-threads', str(threads)])  # Доля ядер в пуле
+    cmd.extend([
         '-profile:v', profile_ffmpeg,  # Профиль из эталона
         '-level:v', level_ffmpeg,  # Уровень из эталона
         '-pix_fmt', reference_params.get('pix_fmt', 'yuv420p'),  # Пиксельный формат
         '-preset', 'medium',  # Баланс скорости и качества
-    ]
+    ])
     
     # Используем битрейт если указан, иначе CRF для качества
     if bitrate_int:
@@ -183,18 +212,154 @@ def normalize_video(input_file, output_file, reference_params, width, height, fp
         '-y',  # Перезаписывать если существует
         str(output_file)
     ])
+    return cmd
+
+
+def video_duration(probe):
+    """Длительность видеопотока (без учёта аудио), иначе длительность контейнера"""
+    video = next((s for s in probe.get('streams', []) if s.get('codec_type') == 'video'), {})
+    try:
+        return float(video['duration'])
+    except (KeyError, TypeError, ValueError):
+        return probe.get('duration')
+
+
+def split_at_keyframes(input_file, segment_dir, segment_seconds):
+    """
+    Режет видеопоток на сегменты без перекодирования (границы — ближайшие ключевые кадры)
+    
+    Args:
+        input_file: Путь к исходному файлу
+        segment_dir: Папка для сегментов (создаётся)
+        segment_seconds: Желаемая длина сегмента, секунд
+    
+    Returns:
+        Список путей сегментов по порядку
+    """
+    segment_dir.mkdir(exist_ok=True)
+    cmd = [
+        'ffmpeg',
+        '-i', str(input_file),
+        '-map', '0:v:0',  # Только видео поток
+        '-c', 'copy',  # Без перекодирования: разрез только по ключевым кадрам
+        '-f', 'segment',
+        '-segment_time', str(segment_seconds),
+        '-reset_timestamps', '1',  # Каждый сегмент с нуля — кодируется как отдельный файл
+        '-y',
+        str(segment_dir / 'src_%04d.mp4')
+    ]
+    subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return sorted(segment_dir.glob('src_*.mp4'))
+
+
+def concat_segments(segments, output_file, list_file):
+    """
+    Склеивает закодированные сегменты демультиплексором concat без перекодирования
+    
+    Args:
+        segments: Пути сегментов по порядку
+        output_file: Путь к выходному файлу
+        list_file: Путь для списка сегментов
+    """
+    with open(list_file, 'w', encoding='utf-8') as f:
+        for segment in segments:
+            escaped = str(Path(segment).resolve()).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    cmd = [
+        'ffmpeg',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', str(list_file),
+        '-c', 'copy',
+        '-y',
+        str(output_file)
+    ]
+    subprocess.run(cmd, capture_output=True, text=True, check=True)
+
+
+def check_joined(source_probe, result_probe, fps):
+    """
+    Сверяет склеенный файл с исходником: число кадров и длительность видео
+    
+    Args:
+        source_probe: Сводка исходного файла
+        result_probe: Сводка склеенного файла
+        fps: FPS файла (допуск длительности — полтора кадра)
+    
+    Returns:
+        Текст расхождения или None
+    """
+    if not result_probe or not result_probe['codec']:
+        return "склеенный файл не читается"
+    if source_probe.get('nb_frames') and result_probe['nb_frames'] != source_probe['nb_frames']:
+        return f"кадров {result_probe['nb_frames']}, в исходнике {source_probe['nb_frames']}"
+    source_duration, result_duration = video_duration(source_probe), video_duration(result_probe)
+    if source_duration and result_duration and abs(result_duration - source_duration) > 1.5 / fps:
+        return f"длительность {result_duration:.3f} с, в исходнике {source_duration:.3f} с"
+    return None
+
+
+def join_segments(job):
+    """
+    Склеивает сегменты файла, проверяет результат и заменяет исходный файл
     
+    Args:
+        job: Словарь сегментированного файла из process_directory
+    
+    Returns:
+        Текст ошибки или None при успехе
+    """
     try:
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        return True
+        failed = sum(1 for task in job['tasks'] if not task['ok'])
+        if failed:
+            return f"не закодировано сегментов: {failed} из {len(job['tasks'])}"
+        concat_segments(job['encoded'], job['temp'], job['dir'] / 'list.txt')
+        error = check_joined(job['probe'], probe_file(job['temp']), job['fps'])
+        if error:
+            return error
+        job['journal'].replace(job['file'].name, job['temp'], job['file'])
+        return None
     except subprocess.CalledProcessError as e:
-        print(f"  Ошибка при конвертации: {e.stderr[:200]}")
-        return False
+        return stderr_tail(e.stderr)
+    except OSError as e:
+        return str(e)
+    finally:
+        if job['temp'].exists():
+            job['temp'].unlink()
+        shutil.rmtree(job['dir'], ignore_errors=True)
+
+
+def resume_directory(dir_path, journal):
+    """
+    Доводит операции прерванного запуска по журналу: полностью записанные временные файлы
+    ставятся на место, недописанные удаляются (такие файлы будут обработаны заново)
+    
+    Args:
+        dir_path: Путь к директории
+        journal: Журнал папки
+    
+    Returns:
+        Количество завершённых замен
+    """
+    finished = 0
+    for name, op in journal.pending().items():
+        temp_file = dir_path / op['temp']
+        if op['state'] == 'ready' and temp_file.exists():
+            journal.replace(name, temp_file, dir_path / name)
+            print(f"  Журнал: завершена замена {name}")
+            finished += 1
+            continue
+        if op['state'] == 'ready':
+            # Замена прошла, не успела только отметка
+            journal.mark(name, 'done')
+            finished += 1
+            continue
+        if temp_file.exists():
+            temp_file.unlink()
+        if op.get('segments'):
+            shutil.rmtree(dir_path / op['segments'], ignore_errors=True)
+        print(f"  Журнал: {name} не был завершён, будет обработан заново")
+    return finished
 
 
 def process_directory(directory_path, reference_params, dry_run=False):
@@ -217,19 +382,36 @@ def process_directory(directory_path, reference_params, dry_run=False):
         'processed': 0,
         'success': 0,
         'errors': 0,
-        'skipped': 0
+        'skipped': 0,
+        'remuxed': 0,
+        'segmented': 0
     }
     
+    # Продолжаем прерванный запуск: до поиска файлов, чтобы не подхватить временные
+    journal = Journal(dir_path / JOURNAL_NAME)
+    if journal.ops and not dry_run:
+        stats['success'] += resume_directory(dir_path, journal)
+    finished = journal.done()
+    
     # Находим все MP4 файлы
     mp4_files = sorted(dir_path.glob('*.mp4'))
+    probes = probe_folder(dir_path, mp4_files)
+    tasks = []
+    segment_jobs = []
+    planned = []
     
     for video_file in mp4_files:
         stats['processed'] += 1
         
         print(f"  [{stats['processed']}/{len(mp4_files)}] {video_file.name}")
         
+        if video_file.name in finished:
+            print(f"    Уже обработан в прерванном запуске, пропускаем")
+            stats['skipped'] += 1
+            continue
+        
         # Получаем параметры исходного файла
-        video_params = get_video_params(video_file)
+        video_params = get_video_params(video_file, probes[video_file] or {})
         if not video_params:
             print(f"    ОШИБКА: Не удалось получить параметры")
             stats['errors'] += 1
@@ -241,33 +423,115 @@ def process_directory(directory_path, reference_params, dry_run=False):
         
         print(f"    Разрешение: {width}x{height}, FPS: {fps:.2f}")
         
+        # Уже нормализованные файлы не перекодируем повторно
+        action = normalization_action(probes[video_file], reference_params)
+        if action == 'skip':
+            print(f"    Уже соответствует эталону, пропускаем")
+            stats['skipped'] += 1
+            continue
+        
+        # Длинный файл кодируется по сегментам параллельно
+        duration = video_duration(probes[video_file])
+        segmented = action == 'encode' and SEGMENT_SECONDS > 0 and duration and duration > 2 * SEGMENT_SECONDS
+        
         if dry_run:
-            print(f"    [DRY RUN] Будет перекодирован с параметрами эталона")
+            if segmented:
+                print(f"    [DRY RUN] Будет перекодирован по сегментам ~{SEGMENT_SECONDS:g} с")
+            elif action == 'remux':
+                print(f"    [DRY RUN] Будет перепакован без перекодирования (лишние потоки)")
+            else:
+                print(f"    [DRY RUN] Будет перекодирован с параметрами эталона")
             stats['success'] += 1
             continue
         
-        # Создаем временный файл
-        temp_file = video_file.parent / f"{video_file.stem}_temp.mp4"
-        output_file = video_file  # Перезаписываем исходный файл
-        
-        # Перекодируем во временный файл
-        if normalize_video(video_file, temp_file, reference_params, width, height, fps):
-            # Если успешно, заменяем исходный файл
+        planned.append({
+            'file': video_file,
+            'temp': video_file.parent / f"{video_file.stem}_temp.mp4",
+            'segments': video_file.parent / f"{video_file.stem}_segments" if segmented else None,
+            'action': action,
+            'params': (width, height, fps),
+            'duration': duration,
+        })
+    
+    # Все операции папки попадают в журнал одной записью до первых записей на диск
+    if planned:
+        journal.plan({
+            op['file'].name: {'temp': op['temp'].name, 'segments': op['segments'].name if op['segments'] else None}
+            for op in planned
+        })
+    
+    for op in planned:
+        video_file, temp_file, segment_dir, action = op['file'], op['temp'], op['segments'], op['action']
+        width, height, fps = op['params']
+        duration = op['duration']
+        if segment_dir:
             try:
-                if output_file.exists():
-                    output_file.unlink()
-                temp_file.rename(output_file)
-                print(f"    Успешно перекодирован")
-                stats['success'] += 1
-            except Exception as e:
-                print(f"    ОШИБКА при замене файла: {e}")
-                if temp_file.exists():
-                    temp_file.unlink()
+                sources = split_at_keyframes(video_file, segment_dir, SEGMENT_SECONDS)
+            except subprocess.CalledProcessError as e:
+                print(f"    ОШИБКА при разбиении {video_file.name} на сегменты: {stderr_tail(e.stderr, 1)}")
+                shutil.rmtree(segment_dir, ignore_errors=True)
                 stats['errors'] += 1
+                continue
+            print(f"    {video_file.name}: длительность {duration:.1f} с, {len(sources)} сегментов, кодируются параллельно")
+            encoded = [segment_dir / f"enc_{i:04d}.mp4" for i in range(len(sources))]
+            segment_jobs.append({
+                'file': video_file,
+                'temp': temp_file,
+                'dir': segment_dir,
+                'encoded': encoded,
+                'probe': probes[video_file],
+                'fps': fps,
+                'journal': journal,
+                'tasks': [
+                    {
+                        'name': f"{video_file.name} [{i + 1}/{len(sources)}]",
+                        'size': source.stat().st_size,
+                        'command': lambda threads, f=source, t=target, w=width, h=height, r=fps:
+                            normalize_command(f, t, reference_params, w, h, r, threads),
+                        'outputs': [target],
+                    }
+                    for i, (source, target) in enumerate(zip(sources, encoded))
+                ],
+            })
+            continue
+        if action == 'remux':
+            print(f"    {video_file.name}: видео соответствует эталону, перепаковка без перекодирования")
+            command = lambda threads, f=video_file, t=temp_file: remux_command(f, t, threads)
         else:
-            if temp_file.exists():
-                temp_file.unlink()
+            command = lambda threads, f=video_file, t=temp_file, w=width, h=height, r=fps: \
+                normalize_command(f, t, reference_params, w, h, r, threads)
+        tasks.append({
+            'name': video_file.name,
+            'size': video_file.stat().st_size,
+            'action': action,
+            'command': command,
+            'outputs': [temp_file],
+            # Если успешно, заменяем исходный файл (атомарно, с отметкой в журнале)
+            'done': lambda f=video_file, t=temp_file: journal.replace(f.name, t, f),
+        })
+    
+    # Перекодирование: несколько ffmpeg одновременно, ядра поделены между ними;
+    # сегменты длинных файлов идут в тот же пул
+    run_pool(tasks + [task for job in segment_jobs for task in job['tasks']])
+    for task in tasks:
+        stats['success' if task['ok'] else 'errors'] += 1
+        if task['ok'] and task['action'] == 'remux':
+            stats['remuxed'] += 1
+    
+    # Склейка сегментов и проверка кадров и длительности
+    for job in segment_jobs:
+        error = join_segments(job)
+        if error:
+            print(f"    ОШИБКА склейки {job['file'].name}: {error}")
             stats['errors'] += 1
+        else:
+            print(f"    Склеен из {len(job['tasks'])} сегментов: {job['file'].name}")
+            stats['success'] += 1
+            stats['segmented'] += 1
+    
+    # Папка пройдена целиком: незавершённых операций не осталось
+    if not dry_run:
+        journal.finish()
     
     return stats
 
@@ -310,7 +574,7 @@ def main():
     auto_confirm = '--yes' in sys.argv or '-y' in sys.argv
     
     if not auto_confirm:
-        print("ВНИМАНИЕ: Все файлы будут перекодированы и перезаписаны!")
+        print("ВНИМАНИЕ: Файлы, не соответствующие эталону, будут перекодированы и перезаписаны!")
         print("Разрешение и FPS каждого файла будут сохранены.")
         print("Остальные параметры будут приведены к эталону.")
         print()
@@ -327,7 +591,9 @@ def main():
         'processed': 0,
         'success': 0,
         'errors': 0,
-        'skipped': 0
+        'skipped': 0,
+        'remuxed': 0,
+        'segmented': 0
     }
     
     # Обработка каждой папки
@@ -348,11 +614,16 @@ def main():
             print(f"  Обработано: {stats['processed']}")
             print(f"  Успешно: {stats['success']}")
             print(f"  Ошибок: {stats['errors']}")
+            print(f"  Пропущено (уже как эталон): {stats['skipped']}")
+            print(f"  Перепаковано без перекодирования: {stats['remuxed']}")
+            print(f"  Закодировано по сегментам: {stats['segmented']}")
             
             total_stats['processed'] += stats['processed']
             total_stats['success'] += stats['success']
             total_stats['errors'] += stats['errors']
             total_stats['skipped'] += stats['skipped']
+            total_stats['remuxed'] += stats['remuxed']
+            total_stats['segmented'] += stats['segmented']
         
         print()
     
@@ -363,6 +634,9 @@ def main():
     print(f"Всего обработано: {total_stats['processed']}")
     print(f"Успешно: {total_stats['success']}")
     print(f"Ошибок: {total_stats['errors']}")
+    print(f"Пропущено (уже как эталон): {total_stats['skipped']}")
+    print(f"Перепаковано без перекодирования: {total_stats['remuxed']}")
+    print(f"Закодировано по сегментам: {total_stats['segmented']}")
     print("=" * 70)
 
 
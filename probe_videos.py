@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Общий модуль чтения параметров видео через ffprobe
+Один JSON-вызов ffprobe на файл (все потоки и формат), файлы опрашиваются параллельно
+ограниченным пулом asyncio-подпроцессов
+"""
+
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+
+
+# Сколько ffprobe держать запущенными одновременно
+MAX_PROBES = int(os.environ.get("PROBE_JOBS", str(min(16, (os.cpu_count() or 4) * 2))))
+
+FFPROBE_CMD = [
+    'ffprobe',
+    '-v', 'quiet',
+    '-print_format', 'json',
+    '-show_streams',
+    '-show_format',
+]
+
+
+def parse_rate(rate):
+    """
+    Разбирает частоту кадров ffprobe ("30000/1001" или "25")
+
+    Args:
+        rate: Строка частоты из ffprobe
+
+    Returns:
+        FPS (float) или None
+    """
+    if not rate or rate in ('0/0', 'N/A'):
+        return None
+    try:
+        if '/' in rate:
+            num, den = map(int, rate.split('/'))
+            return num / den if den > 0 else None
+        return float(rate)
+    except ValueError:
+        return None
+
+
+def parse_number(value, cast=float):
+    """Число из поля ffprobe или None для пустых и 'N/A'"""
+    if value in (None, '', 'N/A'):
+        return None
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def summarize(data):
+    """
+    Сводит JSON ffprobe к плоскому словарю полей, которые используют скрипты
+
+    Args:
+        data: Разобранный JSON ffprobe (-show_streams -show_format)
+
+    Returns:
+        Словарь: codec, profile, level, pix_fmt, color_space, color_range, width, height, fps, bitrate, encoder,
+        nb_frames, duration, size, format_name, format_bitrate, has_audio, а также
+        исходные streams и format
+    """
+    streams = data.get('streams', [])
+    fmt = data.get('format', {})
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None) or {}
+    level = video.get('level')
+
+    return {
+        'codec': video.get('codec_name') or None,
+        'profile': video.get('profile') or None,
+        'level': str(level) if level not in (None, '', -99) else None,
+        'pix_fmt': video.get('pix_fmt') or None,
+        'color_space': video.get('color_space') or None,
+        'color_range': video.get('color_range') or None,
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'fps': parse_rate(video.get('r_frame_rate')),
+        'bitrate': video.get('bit_rate') if parse_number(video.get('bit_rate'), int) else None,
+        'encoder': video.get('tags', {}).get('encoder', ''),
+        'nb_frames': parse_number(video.get('nb_frames'), int),
+        'duration': parse_number(fmt.get('duration')),
+        'size': parse_number(fmt.get('size'), int),
+        'format_name': fmt.get('format_name'),
+        'format_bitrate': parse_number(fmt.get('bit_rate'), int),
+        'has_audio': any(s.get('codec_type') == 'audio' for s in streams),
+        'streams': streams,
+        'format': fmt,
+    }
+
+
+async def _probe_one(path, semaphore):
+    async with semaphore:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *FFPROBE_CMD, str(path),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            return None
+        out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        return None
+    try:
+        return summarize(json.loads(out))
+    except ValueError:
+        return None
+
+
+async def _probe_all(paths, jobs):
+    semaphore = asyncio.Semaphore(max(1, jobs))
+    return await asyncio.gather(*(_probe_one(p, semaphore) for p in paths))
+
+
+def probe_files(paths, jobs=MAX_PROBES):
+    """
+    Опрашивает файлы параллельно, не больше jobs процессов ffprobe одновременно
+
+    Args:
+        paths: Пути к файлам
+        jobs: Размер пула
+
+    Returns:
+        Словарь {путь: сводка summarize() или None, если файл не читается}
+    """
+    paths = list(paths)
+    if not paths:
+        return {}
+    return dict(zip(paths, asyncio.run(_probe_all(paths, jobs))))
+
+
+def probe_file(path):
+    """
+    Опрашивает один файл
+
+    Args:
+        path: Путь к файлу
+
+    Returns:
+        Сводка summarize() или None
+    """
+    return probe_files([path])[path]
+
+
+def main():
+    """Печатает сводку по переданным файлам (для проверки)"""
+    paths = [Path(p) for p in sys.argv[1:]]
+    for path, info in probe_files(paths).items():
+        if info is None:
+            print(f"{path}: не удалось прочитать")
+            continue
+        print(
+            f"{path}: {info['codec']} {info['width']}x{info['height']} "
+            f"{(info['fps'] or 0):.3f} fps | {info['duration']} с | {info['nb_frames']} кадров"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,160 @@
 #!/usr/bin/env python3
 """
 Скрипт для переименования файлов с опечаткой exampe -> example
+Папка читается одним os.scandir, план old -> new строится целиком в памяти с проверкой
+коллизий и циклов и только затем применяется в порядке зависимостей.
+Другие замены: python rename_files.py [--regex] OLD NEW [OLD NEW ...]
 """
 
 import os
+import re
+import sys
 from pathlib import Path
 
+from rewrite_journal import Journal
 
-def rename_files_in_directory(directory_path, old_pattern, new_pattern):
+
+# Журнал переименований в каждой обрабатываемой папке (удаляется после полного прохода)
+JOURNAL_NAME = '.rename_journal'
+
+# Сколько переименований печатать построчно (в папках на 100k+ файлов — только итог)
+PRINT_LIMIT = 50
+
+
+def make_rules(pairs, regex=False):
+    """
+    Готовит правила замены в имени файла
+    
+    Args:
+        pairs: Список (old, new); правила применяются к имени по очереди
+        regex: old — регулярное выражение, в new допустимы ссылки на группы (\\1, \\g<name>)
+    
+    Returns:
+        Список (скомпилированный шаблон, замена) для re.sub
+    """
+    if regex:
+        return [(re.compile(old), new) for old, new in pairs]
+    return [(re.compile(re.escape(old)), new.replace('\\', '\\\\')) for old, new in pairs]
+
+
+def new_name_for(name, rules):
+    """Имя файла после всех правил"""
+    for pattern, replacement in rules:
+        name = pattern.sub(replacement, name)
+    return name
+
+
+def resume_renames(dir_path, journal, stats):
+    """
+    Доводит переименования прерванного запуска по журналу (шаги идут в порядке плана)
+    
+    Args:
+        dir_path: Путь к директории
+        journal: Журнал папки
+        stats: Статистика папки (дополняется)
+    """
+    for old_name, op in journal.pending().items():
+        old_path, new_path = dir_path / old_name, dir_path / op['new']
+        if not old_path.exists() and new_path.exists():
+            # Переименование прошло, не успела только отметка
+            journal.mark(old_name, 'done')
+            continue
+        if old_path.exists() and not new_path.exists():
+            stats['found'] += 1
+            os.replace(old_path, new_path)
+            journal.mark(old_name, 'done')
+            print(f"   Журнал: завершено {old_name} -> {op['new']}")
+            stats['renamed'] += 1
+
+
+def plan_renames(directory_path, rules):
+    """
+    Строит план переименований папки по одному чтению каталога
+    
+    Args:
+        directory_path: Путь к директории
+        rules: Правила make_rules
+    
+    Returns:
+        (steps, problems): steps — список (old, new) в порядке применения
+        (цепочки a -> b -> c с конца, циклы через временное имя),
+        problems — список (old, сообщение) для переименований, которые не выполняются
+    """
+    # Единственное чтение каталога: дальше все проверки по этому снимку
+    with os.scandir(directory_path) as it:
+        entries = {entry.name: entry.is_file() for entry in it}
+    
+    mapping, problems = {}, []
+    by_target = {}
+    for name, is_file in entries.items():
+        if not is_file or name == JOURNAL_NAME:
+            continue
+        new_name = new_name_for(name, rules)
+        if new_name == name:
+            continue
+        if not new_name or new_name in ('.', '..') or '/' in new_name or '\0' in new_name:
+            problems.append((name, f"недопустимое новое имя {new_name!r}"))
+            continue
+        mapping[name] = new_name
+        by_target.setdefault(new_name, []).append(name)
+    
+    # Несколько файлов -> одно имя: не переименовывается ни один из них
+    for target, sources in by_target.items():
+        if len(sources) > 1:
+            for name in sources:
+                del mapping[name]
+                problems.append((name, f"имя {target} получают сразу {len(sources)} файла: {', '.join(sorted(sources))}"))
+    by_target = {target: sources[0] for target, sources in by_target.items() if len(sources) == 1}
+    
+    # Имя занято файлом, который остаётся на месте. Отказ от переименования оставляет
+    # на месте и его исходник, поэтому проверка идёт волной по зависимым переименованиям
+    queue = [name for name, new_name in mapping.items() if new_name in entries and new_name not in mapping]
+    while queue:
+        name = queue.pop()
+        if name not in mapping:
+            continue
+        problems.append((name, f"файл {mapping.pop(name)} уже существует"))
+        blocked = by_target.get(name)
+        if blocked in mapping:
+            queue.append(blocked)
+    
+    # Порядок: сначала освобождаем имя, потом занимаем. У каждого имени не больше одного
+    # входящего и одного исходящего переименования, так что граф — цепочки и циклы
+    steps, state = [], {}
+    taken = set(entries) | set(mapping.values())
+    for start in mapping:
+        path, node = [], start
+        while node in mapping and node not in state:
+            state[node] = 'visiting'
+            path.append(node)
+            node = mapping[node]
+        cycle = []
+        if state.get(node) == 'visiting':
+            # Цикл a -> b -> ... -> a: первый файл уходит во временное имя
+            i = path.index(node)
+            cycle, path = path[i:], path[:i]
+            temp_name, n = f".rename_tmp_{cycle[0]}", 0
+            while temp_name in taken:
+                n += 1
+                temp_name = f".rename_tmp_{n}_{cycle[0]}"
+            taken.add(temp_name)
+            steps.append((cycle[0], temp_name))
+            steps.extend((name, mapping[name]) for name in reversed(cycle[1:]))
+            steps.append((temp_name, mapping[cycle[0]]))
+        steps.extend((name, mapping[name]) for name in reversed(path))
+        for name in path + cycle:
+            state[name] = 'done'
+    
+    return steps, problems
+
+
+def rename_files_in_directory(directory_path, rules):
     """
     Переименовывает файлы в указанной директории
     
     Args:
         directory_path: Путь к директории
-        old_pattern: Старый паттерн для замены
-        new_pattern: Новый паттерн для замены
+        rules: Правила make_rules
     
     Returns:
         Словарь со статистикой: found, renamed, errors
@@ -30,33 +170,59 @@ def rename_files_in_directory(directory_path, old_pattern, new_pattern):
         'error_files': []
     }
     
-    # Находим все файлы с опечаткой
-    all_files = list(dir_path.iterdir())
+    # Сначала доводим прерванный запуск
+    journal = Journal(dir_path / JOURNAL_NAME, durable=False)
+    if journal.ops:
+        resume_renames(dir_path, journal, stats)
+        journal.finish()
+    
+    # План целиком до первого переименования: коллизии не оставляют папку наполовину переименованной
+    steps, problems = plan_renames(dir_path, rules)
+    for name, message in problems:
+        print(f"   ПРЕДУПРЕЖДЕНИЕ: {message}, пропускаем {name}")
+        stats['errors'] += 1
+        stats['error_files'].append(name)
+    stats['found'] += len(problems)
+    if not steps:
+        return stats
+    
+    # План записывается в журнал до первого переименования
+    journal.plan({old_name: {'new': new_name} for old_name, new_name in steps})
     
-    for file_path in all_files:
-        if file_path.is_file() and old_pattern in file_path.name:
+    # Временное имя цикла: шаг в него и шаг из него — одно переименование файла
+    position = {old_name: i for i, (old_name, _) in enumerate(steps)}
+    moved_to_temp = {}
+    # Имена, которые остались заняты из-за неудачного шага: в них переименовывать нельзя
+    stuck = set()
+    for i, (old_name, new_name) in enumerate(steps):
+        try:
+            if new_name in stuck:
+                raise OSError(f"{new_name} не освободился")
+            os.replace(dir_path / old_name, dir_path / new_name)
+            journal.mark(old_name, 'done')
+        except OSError as e:
+            stuck.add(old_name)
+            old_name = moved_to_temp.get(old_name, old_name)
+            print(f"   ОШИБКА при переименовании {old_name}: {e}")
             stats['found'] += 1
-            
-            # Создаем новое имя файла
-            new_name = file_path.name.replace(old_pattern, new_pattern)
-            new_path = file_path.parent / new_name
-            
-            # Проверяем, не существует ли уже файл с таким именем
-            if new_path.exists():
-                print(f"   ПРЕДУПРЕЖДЕНИЕ: Файл {new_name} уже существует, пропускаем {file_path.name}")
-                stats['errors'] += 1
-                stats['error_files'].append(file_path.name)
-                continue
-            
-            try:
-                # Переименовываем файл
-                file_path.rename(new_path)
-                print(f"   Переименован: {file_path.name} -> {new_name}")
-                stats['renamed'] += 1
-            except Exception as e:
-                print(f"   ОШИБКА при переименовании {file_path.name}: {e}")
-                stats['errors'] += 1
-                stats['error_files'].append(file_path.name)
+            stats['errors'] += 1
+            stats['error_files'].append(old_name)
+            continue
+        if position.get(new_name, -1) > i:
+            moved_to_temp[new_name] = old_name
+            continue
+        old_name = moved_to_temp.pop(old_name, old_name)
+        stats['found'] += 1
+        stats['renamed'] += 1
+        if stats['renamed'] <= PRINT_LIMIT:
+            print(f"   Переименован: {old_name} -> {new_name}")
+    if stats['renamed'] > PRINT_LIMIT:
+        print(f"   ... и ещё {stats['renamed'] - PRINT_LIMIT}")
+    
+    # Папка пройдена целиком: журнал нужен, только если остались незавершённые шаги
+    # (например файл застрял во временном имени цикла) — их доведёт следующий запуск
+    if not stuck:
+        journal.finish()
     
     return stats
 
@@ -70,8 +236,18 @@ def main():
     # Список папок для обработки
     folders_to_process = ['example1', 'example2', 'example3', 'example4']
     
+    # Правила из аргументов: [--regex] OLD NEW [OLD NEW ...], по умолчанию exampe -> example
+    args = sys.argv[1:]
+    regex = '--regex' in args
+    args = [arg for arg in args if arg != '--regex']
+    if len(args) % 2:
+        print("Usage: python rename_files.py [--regex] OLD NEW [OLD NEW ...]")
+        sys.exit(1)
+    pairs = list(zip(args[::2], args[1::2])) or [('exampe', 'example')]
+    rules = make_rules(pairs, regex)
+    
     print("=" * 70)
-    print("Переименование файлов: exampe -> example")
+    print(f"Переименование файлов: {', '.join(f'{old} -> {new}' for old, new in pairs)}")
     print("=" * 70)
     print()
     
@@ -95,14 +271,14 @@ def main():
             print()
             continue
         
-        stats = rename_files_in_directory(folder_path, 'exampe', 'example')
+        stats = rename_files_in_directory(folder_path, rules)
         
         if stats is None:
             print(f"   ОШИБКА: Не удалось обработать папку")
             print()
             continue
         
-        print(f"   Найдено файлов с опечаткой: {stats['found']}")
+        print(f"   Найдено файлов для переименования: {stats['found']}")
         print(f"   Успешно переименовано: {stats['renamed']}")
         if stats['errors'] > 0:
             print(f"   Ошибок: {stats['errors']}")
@@ -118,7 +294,7 @@ def main():
     print("=" * 70)
     print("ИТОГОВАЯ СТАТИСТИКА")
     print("=" * 70)
-    print(f"Всего найдено файлов с опечаткой: {total_stats['found']}")
+    print(f"Всего найдено файлов для переименования: {total_stats['found']}")
     print(f"Успешно переименовано: {total_stats['renamed']}")
     print(f"Ошибок: {total_stats['errors']}")
     
@@ -132,4 +308,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
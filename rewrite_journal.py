@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Журнал операций на диске для скриптов, переписывающих файлы на месте
+План пишется атомарно (временный файл + os.replace), выполненные шаги дописываются строками;
+после сбоя скрипт читает журнал и повторяет только незавершённые операции
+"""
+
+import json
+import os
+import threading
+from pathlib import Path
+
+
+class Journal:
+    """
+    Журнал операций папки: {ключ: {'state': ..., поля операции}}
+
+    Формат — JSON-строки: каждая строка обновляет одну операцию; недописанная
+    последняя строка (сбой во время записи) при чтении отбрасывается
+    """
+
+    def __init__(self, path, durable=True):
+        """
+        Args:
+            path: Путь к файлу журнала
+            durable: fsync после каждого шага (иначе только при записи плана)
+        """
+        self.path = Path(path)
+        self.durable = durable
+        self.lock = threading.Lock()
+        self.ops = {}
+        self._file = None
+        if self.path.exists():
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    self.ops.setdefault(record.pop('key'), {}).update(record)
+
+    def pending(self):
+        """Операции прерванного запуска, которые не дошли до 'done'"""
+        return {key: op for key, op in self.ops.items() if op.get('state') != 'done'}
+
+    def done(self):
+        """Ключи операций, завершённых в прерванном запуске"""
+        return {key for key, op in self.ops.items() if op.get('state') == 'done'}
+
+    def plan(self, entries):
+        """
+        Записывает операции в состоянии 'planned' (журнал переписывается целиком, атомарно)
+
+        Args:
+            entries: Словарь {ключ: поля операции}
+        """
+        with self.lock:
+            ops = dict(self.ops)
+            ops.update({key: {'state': 'planned', **fields} for key, fields in entries.items()})
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for key, op in ops.items():
+                    f.write(json.dumps({'key': key, **op}, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._close()
+            os.replace(tmp, self.path)
+            self.ops = ops
+
+    def mark(self, key, state):
+        """
+        Отмечает шаг операции (дописывает строку в журнал)
+
+        Args:
+            key: Ключ операции
+            state: Новое состояние ('done' — операция завершена)
+        """
+        with self.lock:
+            self.ops.setdefault(key, {})['state'] = state
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(json.dumps({'key': key, 'state': state}, ensure_ascii=False) + '\n')
+            self._file.flush()
+            if self.durable:
+                os.fsync(self._file.fileno())
+
+    def replace(self, key, source, target):
+        """
+        Атомарно заменяет target готовым source с отметками в журнале до и после:
+        'ready' — source дописан полностью, при сбое замену можно завершить
+
+        Args:
+            key: Ключ операции
+            source: Готовый временный файл
+            target: Заменяемый файл
+        """
+        self.mark(key, 'ready')
+        os.replace(source, target)
+        self.mark(key, 'done')
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """Проход завершён: журнал больше не нужен"""
+        with self.lock:
+            self._close()
+            if self.path.exists():
+                self.path.unlink()
+            self.ops = {}
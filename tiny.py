@@ -19,9 +19,17 @@ torch.backends.cudnn.allow_tf32 = True
 from diffsynth import ModelManager, FlashVSRTinyPipeline
 from utils.utils import Buffer_LQ4x_Proj
 from utils.TCDecoder import build_tcdecoder
+from ffmpeg_frames import iter_ffmpeg_frames
+from flashvsr_tuning import tuned_params
 
 # Глобальная настройка: кэп по длинной стороне итогового HR (кратно 128)
 MAX_LONG = int(os.environ.get("FLASHVSR_MAX_LONG", "1536"))  # например, 2048/2304/1792
+# Источник кадров для видео: imageio (полный кадр + PIL) или ffmpeg (ресайз прямо в пайпе декодера,
+# полноразмерные RGB кадры в Python не попадают)
+FRAME_SOURCE = os.environ.get("FLASHVSR_FRAME_SOURCE", "imageio")
+# Раздел таблицы sparse_ratio/local_range (flashvsr_tuning.py); своего --tune у варианта нет,
+# раздел заполняется вручную, без строки для корзины — 2.0 и 11
+VARIANT = "tiny"
 
 def tensor2video(frames):
     frames = rearrange(frames, "C T H W -> T H W C")
@@ -160,14 +168,19 @@ def prepare_input_tensor(path: str, scale: float = 4, dtype=torch.bfloat16, devi
         print(f"[{os.path.basename(path)}] Target Frames (8n-3): {F-4}")
 
         frames = []
-        try:
-            for i in idx:
-                img = Image.fromarray(rdr.get_data(i)).convert('RGB')
-                img_out = resize_to_target(img, tW=tW, tH=tH)
+        if FRAME_SOURCE == 'ffmpeg':
+            rdr.close()
+            for img_out in iter_ffmpeg_frames(path, f"scale={tW}:{tH}:flags=bicubic", tW, tH, idx):
                 frames.append(pil_to_tensor_neg1_1(img_out, dtype, device))
-        finally:
-            try: rdr.close()
-            except Exception: pass
+        else:
+            try:
+                for i in idx:
+                    img = Image.fromarray(rdr.get_data(i)).convert('RGB')
+                    img_out = resize_to_target(img, tW=tW, tH=tH)
+                    frames.append(pil_to_tensor_neg1_1(img_out, dtype, device))
+            finally:
+                try: rdr.close()
+                except Exception: pass
 
         vid = torch.stack(frames, 0).permute(1,0,2,3).unsqueeze(0)  # 1 C F H W
         return vid, tH, tW, F, fps
@@ -218,13 +231,14 @@ def main():
             LQ, th, tw, F, fps = prepare_input_tensor(p, scale=scale, dtype=dtype, device=device)
         except Exception as e:
             print(f"[Error] {name}: {e}"); continue
+        sr, lr = tuned_params(VARIANT, tw, th, sparse_ratio, 11)
 
         video = pipe(
             prompt="", negative_prompt="", cfg_scale=1.0, num_inference_steps=1, seed=seed,
             LQ_video=LQ, num_frames=F, height=th, width=tw, is_full_block=False, if_buffer=True,
-            topk_ratio=sparse_ratio*768*1280/(th*tw),
+            topk_ratio=sr*768*1280/(th*tw),
             kv_ratio=3.0,
-            local_range=11,  # Recommended: 9 or 11. local_range=9 → sharper details; 11 → more stable results.
+            local_range=lr,  # Recommended: 9 or 11. local_range=9 → sharper details; 11 → more stable results.
             color_fix = True,
         )
         video = tensor2video(video)
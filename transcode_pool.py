@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Общий пул перекодирования для convert_videos и normalize_videos
+Запускает несколько ffmpeg одновременно и делит между ними ядра через -threads;
+задания идут от больших файлов к меньшим, ошибки собираются и печатаются в конце
+"""
+
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+
+# Сколько ffmpeg держать запущенными одновременно
+MAX_JOBS = int(os.environ.get("TRANSCODE_JOBS", str(min(8, max(1, (os.cpu_count() or 4) // 4)))))
+
+
+def threads_per_job(jobs, cores=None):
+    """
+    Делит ядра между одновременными заданиями
+
+    Args:
+        jobs: Число одновременных заданий
+        cores: Число ядер (по умолчанию os.cpu_count())
+
+    Returns:
+        Значение -threads для одного ffmpeg (не меньше 1)
+    """
+    cores = cores or os.cpu_count() or 1
+    return max(1, cores // max(1, jobs))
+
+
+def stderr_tail(text, lines=5):
+    """Последние строки вывода ffmpeg — в них причина ошибки"""
+    return '\n'.join((text or '').strip().splitlines()[-lines:])
+
+
+def run_task(task, threads):
+    """
+    Выполняет одно задание пула
+
+    Args:
+        task: Словарь задания (см. run_pool)
+        threads: Значение -threads для ffmpeg
+
+    Returns:
+        Текст ошибки или None при успехе
+    """
+    try:
+        subprocess.run(task['command'](threads), capture_output=True, text=True, check=True)
+        if task.get('done'):
+            task['done']()
+        return None
+    except subprocess.CalledProcessError as e:
+        error = stderr_tail(e.stderr)
+    except Exception as e:
+        error = str(e)
+    # Недописанный выход иначе был бы принят за готовый при следующем запуске
+    for output in task.get('outputs', ()):
+        if Path(output).exists():
+            Path(output).unlink()
+    return error
+
+
+def run_pool(tasks, jobs=MAX_JOBS):
+    """
+    Выполняет задания перекодирования параллельно
+
+    Args:
+        tasks: Список словарей заданий:
+            name — имя для прогресса, size — размер исходника в байтах (порядок запуска),
+            command(threads) — список аргументов ffmpeg, outputs — файлы, удаляемые при ошибке,
+            done() — необязательное действие после успешного ffmpeg (например замена исходника)
+        jobs: Число одновременных ffmpeg
+
+    Returns:
+        Список (name, текст ошибки) для неудачных заданий; у каждого задания выставляется task['ok']
+    """
+    if not tasks:
+        return []
+    jobs = max(1, min(jobs, len(tasks)))
+    threads = threads_per_job(jobs)
+    # Крупные файлы первыми: самое длинное задание не остаётся в хвосте одно
+    ordered = sorted(tasks, key=lambda t: t.get('size', 0), reverse=True)
+    total_size = sum(t.get('size', 0) for t in ordered) or 1
+
+    print(f"  Параллельно: {jobs} ffmpeg × {threads} потоков, заданий: {len(ordered)}")
+    done_count, done_size, failures = 0, 0, []
+    started = time.time()
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(run_task, task, threads): task for task in ordered}
+        for future in as_completed(futures):
+            task = futures[future]
+            error = future.result()
+            task['ok'] = error is None
+            done_count += 1
+            done_size += task.get('size', 0)
+            if error is not None:
+                failures.append((task['name'], error))
+            mark = 'готово' if error is None else 'ОШИБКА'
+            print(
+                f"  [{done_count}/{len(ordered)}] {done_size * 100 / total_size:3.0f}% "
+                f"{mark}: {task['name']} ({time.time() - started:.1f} с)"
+            )
+
+    if failures:
+        print(f"  Ошибок: {len(failures)}")
+        for name, error in failures:
+            print(f"   - {name}:")
+            for line in error.splitlines():
+                print(f"       {line}")
+    return failures